@@ -12,6 +12,7 @@ import logging
 from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
+from instrumentation import instrument, detect_n_plus_one
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
@@ -20,6 +21,10 @@ app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
 db = SQLAlchemy(app)
+# Server-Timing on every response, histograms on /metrics
+instrument(app)
+if app.debug:
+    detect_n_plus_one(app)
 
 # TODO: connect to a local postgresql database
 
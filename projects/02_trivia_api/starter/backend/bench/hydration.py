@@ -0,0 +1,122 @@
+'''
+Micro-benchmark of the question list read path.
+
+Times the same reads two ways, inside an app context and without HTTP:
+loading Question instances and calling format() on each (the ORM path),
+and selecting the columns with Question.projection() and serializing the
+row tuples with Question.format_row() (the projection path):
+
+    python -m bench.hydration --database-url sqlite:///bench.db --questions 100000 --output hydration.json
+
+Each case runs --repeat rounds of --number calls; the report has the best
+and median time per call and the projection's speedup over the ORM.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import db, Question
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from bench.loadtest import seed, git_commit
+
+'''
+Cases: (name, shape). A shape adds the filter, order and limit of one
+read to a query, and is applied to both Question.query and
+Question.projection().
+'''
+def cases(questions):
+  middle = max(0, questions // 2)
+  return [
+    ('page', lambda query: query.filter(Question.id > middle).order_by(Question.id).limit(QUESTIONS_PER_PAGE)),
+    ('page_of_100', lambda query: query.filter(Question.id > middle).order_by(Question.id).limit(100)),
+    ('category', lambda query: query.filter(Question.category == 1).order_by(Question.id)),
+  ]
+
+
+def orm_read(shape):
+  rows = [question.format() for question in shape(Question.query).all()]
+  # identity map entries would otherwise pile up across calls
+  db.session.expunge_all()
+  return rows
+
+def projection_read(shape):
+  return [Question.format_row(row) for row in shape(Question.projection()).all()]
+
+'''
+measure(read, shape, number, repeat)
+    seconds per call of read(shape): the best and the median of `repeat`
+    rounds of `number` calls
+'''
+def measure(read, shape, number, repeat):
+  rounds = timeit.repeat(lambda: read(shape), number=number, repeat=repeat)
+  per_call = [elapsed / number for elapsed in rounds]
+  return min(per_call), statistics.median(per_call)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Compare ORM and projection reads of questions.')
+  parser.add_argument('--database-url', default='sqlite:///bench.db',
+    help='database to seed and to read from (default: sqlite:///bench.db)')
+  parser.add_argument('--questions', type=int, default=10000, help='synthetic questions to seed')
+  parser.add_argument('--no-seed', action='store_true', help='reuse the data of a previous run')
+  parser.add_argument('--number', type=int, default=20, help='calls per round')
+  parser.add_argument('--repeat', type=int, default=5, help='rounds per case')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the JSON report here instead of stdout')
+  args = parser.parse_args(argv)
+
+  app = create_app({'DATABASE_URL': args.database_url})
+  if args.no_seed:
+    with app.app_context():
+      args.questions = db.session.query(db.func.max(Question.id)).scalar() or 0
+  else:
+    print('seeding {} questions into {}'.format(args.questions, args.database_url), file=sys.stderr)
+    seed(app, args.questions, args.seed)
+
+  report = {
+    'meta': {
+      'commit': git_commit(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'python': platform.python_version(),
+      'database': None,
+      'questions': args.questions,
+      'number': args.number,
+      'repeat': args.repeat,
+    },
+    'cases': {},
+  }
+  with app.app_context():
+    report['meta']['database'] = db.engine.dialect.name
+    for name, shape in cases(args.questions):
+      print('measuring {}'.format(name), file=sys.stderr)
+      if orm_read(shape) != projection_read(shape):
+        raise SystemExit('{}: the two paths returned different questions'.format(name))
+
+      rows = len(projection_read(shape))
+      orm_best, orm_median = measure(orm_read, shape, args.number, args.repeat)
+      projection_best, projection_median = measure(projection_read, shape, args.number, args.repeat)
+      to_ms = lambda seconds: round(seconds * 1000, 3)
+      report['cases'][name] = {
+        'rows': rows,
+        'orm_ms': {'best': to_ms(orm_best), 'median': to_ms(orm_median)},
+        'projection_ms': {'best': to_ms(projection_best), 'median': to_ms(projection_median)},
+        'speedup': round(orm_median / projection_median, 2) if projection_median else None,
+      }
+
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,314 @@
+'''
+Load test for the trivia backend.
+
+Seeds a synthetic question bank of the requested size, then drives each
+endpoint with a fixed number of concurrent clients for a fixed time and
+writes p50/p95/p99 latency and throughput as JSON, so runs can be diffed
+between commits:
+
+    python -m bench.loadtest --database-url sqlite:///bench.db --questions 100000 \
+        --concurrency 8 --duration 10 --output before.json
+
+Without --url requests go through the Flask app in this process; with
+--url (e.g. http://localhost:5000) they go over HTTP to a running server,
+which is how the asyncio app or a gunicorn setup is measured.
+'''
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+from models import db, Question, Category, CategoryCount, backfill_category_counts, bump_cache_version, reset_question_count
+from flaskr import create_app, encode_cursor, QUESTIONS_PER_PAGE
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+VOCABULARY_SIZE = 5000
+SEED_CHUNK_SIZE = 5000
+
+
+def vocabulary(rng):
+  syllables = ['ka', 'lo', 'mi', 'ne', 'su', 'ra', 'to', 'vi', 'del', 'mar', 'quen', 'tor', 'zi', 'bel']
+  words = set()
+  while len(words) < VOCABULARY_SIZE:
+    words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+  return sorted(words)
+
+'''
+seed(app, questions, seed)
+    replaces the questions and categories with a synthetic bank of
+    `questions` rows, inserted in executemany chunks. The same seed gives
+    the same data. Bumps the questions and categories cache versions so
+    running servers drop what they cached from the old data.
+'''
+def seed(app, questions, seed=0):
+  rng = random.Random(seed)
+  words = vocabulary(rng)
+  with app.app_context():
+    db.session.execute(CategoryCount.__table__.delete())
+    db.session.execute(Question.__table__.delete())
+    db.session.execute(Category.__table__.delete())
+    db.session.execute(Category.__table__.insert(),
+      [{'id': i, 'type': name} for i, name in enumerate(CATEGORIES, start=1)])
+
+    chunk = []
+    for i in range(1, questions + 1):
+      chunk.append({
+        'id': i,
+        'question': ' '.join(rng.choice(words) for _ in range(rng.randint(6, 14))) + '?',
+        'answer': rng.choice(words),
+        'category': rng.randint(1, len(CATEGORIES)),
+        'difficulty': rng.randint(1, 5),
+      })
+      if len(chunk) == SEED_CHUNK_SIZE:
+        db.session.execute(Question.__table__.insert(), chunk)
+        chunk = []
+    if chunk:
+      db.session.execute(Question.__table__.insert(), chunk)
+    # the servers' caches must not keep serving the data replaced here
+    bump_cache_version(Question.__tablename__)
+    bump_cache_version(Category.__tablename__)
+    db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+      db.session.execute("SELECT setval('questions_id_seq', :last)", {'last': questions})
+      db.session.execute("SELECT setval('categories_id_seq', :last)", {'last': len(CATEGORIES)})
+      db.session.commit()
+    backfill_category_counts()
+  reset_question_count()
+  cache.invalidate_all()
+  return words
+
+
+'''
+Scenarios: each returns (method, path, json body or None) for one request.
+They only rely on ids 1..questions existing, as created by seed().
+'''
+def scenarios(questions, words):
+  pages = max(1, questions // QUESTIONS_PER_PAGE)
+
+  def categories(rng, state):
+    return 'GET', '/categories', None
+
+  def questions_page(rng, state):
+    return 'GET', '/questions?page={}'.format(rng.randint(1, pages)), None
+
+  def questions_cursor(rng, state):
+    return 'GET', '/questions?after={}'.format(encode_cursor(rng.randint(0, max(0, questions - QUESTIONS_PER_PAGE)))), None
+
+  def category_questions(rng, state):
+    return 'GET', '/categories/{}/questions'.format(rng.randint(1, len(CATEGORIES))), None
+
+  def search(rng, state):
+    return 'POST', '/questions', {'searchTerm': rng.choice(words)[:4]}
+
+  def quiz(rng, state):
+    previous = [rng.randint(1, questions) for _ in range(20)]
+    return 'POST', '/quizzes', {'previous_questions': previous, 'quiz_category': {'id': rng.randint(0, len(CATEGORIES))}}
+
+  def quiz_session(rng, state):
+    if 'session_id' not in state:
+      return 'POST', '/quizzes/sessions', {'quiz_category': {'id': rng.randint(0, len(CATEGORIES))}}
+    return 'POST', '/quizzes', {'session_id': state['session_id']}
+
+  return {
+    'categories': categories,
+    'questions_page': questions_page,
+    'questions_cursor': questions_cursor,
+    'category_questions': category_questions,
+    'search': search,
+    'quiz': quiz,
+    'quiz_session': quiz_session,
+  }
+
+
+class InProcessClient:
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def request(self, method, path, body):
+    response = self.client.open(path, method=method, json=body)
+    return response.status_code, response.get_json(silent=True)
+
+  def close(self):
+    pass
+
+
+class HTTPClient:
+  '''one keep-alive connection per worker'''
+  def __init__(self, url):
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    self.connection = connection_class(parts.netloc, timeout=30)
+    self.prefix = parts.path.rstrip('/')
+
+  def request(self, method, path, body):
+    headers = {}
+    payload = None
+    if body is not None:
+      payload = json.dumps(body)
+      headers['Content-Type'] = 'application/json'
+    self.connection.request(method, self.prefix + path, payload, headers)
+    response = self.connection.getresponse()
+    data = response.read()
+    try:
+      return response.status, json.loads(data)
+    except ValueError:
+      return response.status, None
+
+  def close(self):
+    self.connection.close()
+
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+  return sorted_values[index]
+
+'''
+drive(make_client, scenario, concurrency, duration)
+    runs `concurrency` workers issuing requests back to back for
+    `duration` seconds and summarises their latencies
+'''
+def drive(make_client, scenario, concurrency, duration, seed=0):
+  deadline = time.perf_counter() + duration
+  lock = threading.Lock()
+  latencies = []
+  errors = []
+  client_errors = []
+
+  def worker(worker_id):
+    rng = random.Random(seed * 1000 + worker_id)
+    client = make_client()
+    state = {}
+    own_latencies = []
+    own_errors = 0
+    own_client_errors = 0
+    try:
+      while time.perf_counter() < deadline:
+        method, path, body = scenario(rng, state)
+        started = time.perf_counter()
+        try:
+          status, data = client.request(method, path, body)
+        except Exception:
+          status, data = None, None
+        own_latencies.append(time.perf_counter() - started)
+        if status is None or status >= 500:
+          own_errors += 1
+        elif status >= 400:
+          own_client_errors += 1
+        elif isinstance(data, dict) and data.get('session_id'):
+          state['session_id'] = data['session_id']
+          if data.get('question', True) is None:
+            # played the whole category, start over
+            state.pop('session_id')
+    finally:
+      client.close()
+    with lock:
+      latencies.extend(own_latencies)
+      errors.append(own_errors)
+      client_errors.append(own_client_errors)
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    list(executor.map(worker, range(concurrency)))
+  elapsed = time.perf_counter() - started
+
+  latencies.sort()
+  to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+  return {
+    'requests': len(latencies),
+    'errors': sum(errors),
+    'client_errors': sum(client_errors),
+    'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+    'latency_ms': {
+      'p50': to_ms(percentile(latencies, 0.50)),
+      'p95': to_ms(percentile(latencies, 0.95)),
+      'p99': to_ms(percentile(latencies, 0.99)),
+      'mean': to_ms(sum(latencies) / len(latencies)) if latencies else None,
+      'max': to_ms(latencies[-1]) if latencies else None,
+    },
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+      cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Load test the trivia backend.')
+  parser.add_argument('--database-url', default='sqlite:///bench.db',
+    help='database to seed and to serve from (default: sqlite:///bench.db)')
+  parser.add_argument('--questions', type=int, default=10000, help='synthetic questions to seed')
+  parser.add_argument('--no-seed', action='store_true', help='reuse the data of a previous run')
+  parser.add_argument('--url', help='drive a running server over HTTP instead of the app in process')
+  parser.add_argument('--concurrency', type=int, default=8)
+  parser.add_argument('--duration', type=float, default=10.0, help='seconds per endpoint')
+  parser.add_argument('--endpoints', help='comma separated scenarios to run (default: all)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the JSON report here instead of stdout')
+  args = parser.parse_args(argv)
+
+  app = create_app({'DATABASE_URL': args.database_url})
+  if args.no_seed:
+    with app.app_context():
+      args.questions = db.session.query(db.func.max(Question.id)).scalar() or 0
+      words = sorted({word.rstrip('?') for (text,) in db.session.query(Question.question).limit(1000)
+                      for word in text.split()}) or ['a']
+  else:
+    print('seeding {} questions into {}'.format(args.questions, args.database_url), file=sys.stderr)
+    words = seed(app, args.questions, args.seed)
+
+  available = scenarios(args.questions, words)
+  names = args.endpoints.split(',') if args.endpoints else list(available)
+  unknown = [name for name in names if name not in available]
+  if unknown:
+    parser.error('unknown endpoints: {}'.format(', '.join(unknown)))
+
+  if args.url:
+    make_client = lambda: HTTPClient(args.url)
+  else:
+    make_client = lambda: InProcessClient(app)
+
+  report = {
+    'meta': {
+      'commit': git_commit(),
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'python': platform.python_version(),
+      'database': db.engine.dialect.name if not args.url else None,
+      'target': args.url or 'in-process',
+      'questions': args.questions,
+      'concurrency': args.concurrency,
+      'duration_s': args.duration,
+    },
+    'endpoints': {},
+  }
+  for name in names:
+    print('driving {}'.format(name), file=sys.stderr)
+    report['endpoints'][name] = drive(make_client, available[name], args.concurrency, args.duration, args.seed)
+
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+
+if __name__ == '__main__':
+  main()
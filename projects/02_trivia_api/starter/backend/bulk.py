@@ -0,0 +1,127 @@
+import json
+import zlib
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+
+'''
+read_rows(request)
+    the rows of a bulk request, in order, as (line, row) pairs. Accepts a
+    JSON array, or NDJSON (one object per line) which is read straight
+    off the request stream instead of being buffered and parsed whole.
+    A line that isn't valid JSON is yielded as None so it can be reported
+    along with the other row errors.
+'''
+def read_rows(request):
+  if request.mimetype in NDJSON_MIMETYPES:
+    return ndjson_rows(request.stream)
+  return array_rows(request.get_json(silent=True))
+
+def ndjson_rows(lines):
+  for line_number, line in enumerate(lines, start=1):
+    line = line.strip()
+    if line:
+      yield line_number, ndjson_row(line)
+
+def ndjson_row(line):
+  try:
+    return json.loads(line)
+  except ValueError:
+    return None
+
+def array_rows(rows):
+  if not isinstance(rows, list):
+    raise ValueError('expected a JSON array or NDJSON')
+  return enumerate(rows, start=1)
+
+
+DIFFICULTIES = range(1, 6)
+
+def is_integer(value):
+  # bool is an int too, but {"category": true} is not a category id
+  return isinstance(value, int) and not isinstance(value, bool)
+
+'''
+validate_question(row, category_ids)
+    checks one imported question and returns (values, error). values is
+    ready to insert; error is None unless the row has to be skipped.
+    difficulty and category must be JSON integers, difficulty from 1 to 5.
+'''
+def validate_question(row, category_ids):
+  if not isinstance(row, dict):
+    return None, 'row is not a JSON object'
+
+  for field in ('question', 'answer', 'difficulty', 'category'):
+    if field not in row or row[field] in (None, ''):
+      return None, 'missing {}'.format(field)
+
+  difficulty, category = row['difficulty'], row['category']
+  if not is_integer(difficulty) or not is_integer(category):
+    return None, 'difficulty and category must be integers'
+  if difficulty not in DIFFICULTIES:
+    return None, 'difficulty must be from 1 to 5'
+
+  if category not in category_ids:
+    return None, 'unknown category {}'.format(category)
+
+  return {
+    'question': str(row['question']),
+    'answer': str(row['answer']),
+    'difficulty': difficulty,
+    'category': category,
+  }, None
+
+
+'''
+delete_criteria(data)
+    the criteria of a bulk delete request as keyword arguments for
+    Question.bulk_delete: ids (a JSON array of integers), category and
+    difficulty (integers). Raises ValueError for anything else, a string
+    of ids included, and when no criterion is given.
+'''
+def delete_criteria(data):
+  if not isinstance(data, dict):
+    raise ValueError('expected a JSON object')
+
+  criteria = {}
+  if "ids" in data:
+    ids = data["ids"]
+    if not isinstance(ids, list) or not all(is_integer(q_id) for q_id in ids):
+      raise ValueError('ids must be an array of integers')
+    criteria["ids"] = ids
+  for field in ("category", "difficulty"):
+    if field in data:
+      if not is_integer(data[field]):
+        raise ValueError('{} must be an integer'.format(field))
+      criteria[field] = data[field]
+
+  if not criteria:
+    raise ValueError('no criterion given')
+  return criteria
+
+
+'''
+ndjson_chunk(rows)
+    a batch of rows as NDJSON bytes, one object per line
+'''
+def ndjson_chunk(rows):
+  return ''.join(json.dumps(row) + '\n' for row in rows).encode()
+
+def ndjson_chunks(batches):
+  for rows in batches:
+    yield ndjson_chunk(rows)
+
+'''
+gzip_compressor()
+    a zlib compressor writing the gzip format, to compress a stream as it
+    is produced
+'''
+def gzip_compressor(level=6):
+  return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def gzip_chunks(chunks):
+  compressor = gzip_compressor()
+  for chunk in chunks:
+    compressed = compressor.compress(chunk)
+    if compressed:
+      yield compressed
+  yield compressor.flush()
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+import weakref
+
+from routing import on_primary
+
+_registry = {}
+
+'''
+VersionedCache
+    keeps the result of an expensive loader in the process.
+    The value is tagged with a version stamp read through `version_getter`
+    (models.cache_version), which writers bump in the same transaction as
+    their change. The stamp is re-read at most every `check_interval`
+    seconds, that is how a process notices writes made by other workers;
+    writes made by this process call invalidate() and are seen at once.
+    Stamp and loader read from the primary, a replica's lagging rows
+    would be served to every request until the next write.
+    With an `updater(value, change)` a write of this process is applied
+    to the cached value in place (see apply) instead of reloading it.
+'''
+class VersionedCache:
+  def __init__(self, name, loader, version_getter, check_interval=5, updater=None):
+    self.name = name
+    self.loader = loader
+    self.version_getter = version_getter
+    self.check_interval = check_interval
+    self.updater = updater
+    self._lock = threading.Lock()
+    self._value = None
+    self._version = None
+    self._loaded = False
+    self._checked_at = 0
+    _registry.setdefault(name, weakref.WeakSet()).add(self)
+
+  def get(self):
+    now = time.monotonic()
+    with self._lock:
+      if self._loaded and now - self._checked_at < self.check_interval:
+        return self._value
+
+      # read the stamp before loading, a write landing in between only
+      # makes the next check reload again
+      with on_primary():
+        version = self.version_getter()
+        if not self._loaded or version != self._version:
+          self._value = self.loader()
+          self._version = version
+          self._loaded = True
+      self._checked_at = now
+
+      return self._value
+
+  def invalidate(self):
+    with self._lock:
+      self._loaded = False
+
+  '''
+  sync(version)
+      `version` was just read for the same table (an ETag is built from
+      it). A value older than that is dropped so the body can't be staler
+      than its tag, the same one counts as a fresh check.
+  '''
+  def sync(self, version):
+    with self._lock:
+      if not self._loaded:
+        return
+      if self._version < version:
+        self._loaded = False
+      elif self._version == version:
+        self._checked_at = time.monotonic()
+
+  '''
+  apply(change, version)
+      a write of this process committed `change` and bumped the stamp to
+      `version`. When the cached value is the one just before it, the
+      updater patches it and the cache takes the new stamp; otherwise
+      another worker wrote in between (or there is no updater) and the
+      value is reloaded on next use. The updater must be idempotent, a
+      load running concurrently with the write may already contain it.
+  '''
+  def apply(self, change, version):
+    with self._lock:
+      if self.updater is None or not self._loaded or self._version != version - 1:
+        self._loaded = False
+        return
+      self.updater(self._value, change)
+      self._version = version
+
+
+'''
+AsyncVersionedCache
+    the same cache for the asyncio app (flaskr/aio.py), loader and
+    version_getter are coroutine functions. Shares the registry, so
+    invalidate(name) reaches both kinds.
+'''
+class AsyncVersionedCache:
+  def __init__(self, name, loader, version_getter, check_interval=5):
+    self.name = name
+    self.loader = loader
+    self.version_getter = version_getter
+    self.check_interval = check_interval
+    # created on first use so it belongs to the loop serving the app
+    self._lock = None
+    self._value = None
+    self._version = None
+    self._loaded = False
+    self._checked_at = 0
+    _registry.setdefault(name, weakref.WeakSet()).add(self)
+
+  async def get(self):
+    now = time.monotonic()
+    if self._loaded and now - self._checked_at < self.check_interval:
+      return self._value
+
+    if self._lock is None:
+      self._lock = asyncio.Lock()
+    async with self._lock:
+      if self._loaded and now - self._checked_at < self.check_interval:
+        return self._value
+
+      version = await self.version_getter()
+      if not self._loaded or version != self._version:
+        self._value = await self.loader()
+        self._version = version
+        self._loaded = True
+      self._checked_at = now
+
+      return self._value
+
+  def invalidate(self):
+    self._loaded = False
+
+  def sync(self, version):
+    if not self._loaded:
+      return
+    if self._version < version:
+      self._loaded = False
+    elif self._version == version:
+      self._checked_at = time.monotonic()
+
+  def apply(self, change, version):
+    self.invalidate()
+
+
+'''
+invalidate(name)
+    drops every cache of this process registered under `name`
+'''
+def invalidate(name):
+  for versioned_cache in list(_registry.get(name, ())):
+    versioned_cache.invalidate()
+
+
+'''
+sync(name, version)
+    lets every cache of this process registered under `name` know the
+    table is at `version`, see VersionedCache.sync
+'''
+def sync(name, version):
+  for versioned_cache in list(_registry.get(name, ())):
+    versioned_cache.sync(version)
+
+
+'''
+apply(name, change, version)
+    hands a committed write to every cache of this process registered
+    under `name`, those that can't patch their value drop it
+'''
+def apply(name, change, version):
+  for versioned_cache in list(_registry.get(name, ())):
+    versioned_cache.apply(change, version)
+
+
+'''
+invalidate_all()
+    drops every cache of this process, for when the data changed under
+    them without a version bump (the tests rolling back their transaction)
+'''
+def invalidate_all():
+  for name in list(_registry):
+    invalidate(name)
@@ -1,33 +1,135 @@
+import base64
+import hashlib
 import json
 import os
-from flask import Flask, request, abort, jsonify
+from functools import wraps
+from flask import Flask, Response, request, abort, jsonify, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 import sys
 
 from sqlalchemy.sql.elements import Null
 
-from models import setup_db, Question, Category
+from models import db, setup_db, database_path, Question, Category, question_count, cache_version, table_versions, question_max_id, category_counts
+import cache
+from cache import VersionedCache
+from search import QuestionSearch
+from quiz import QuizSampler, QuizSession, DatabaseSessionStore, MemorySessionStore
+from bulk import read_rows, validate_question, delete_criteria, ndjson_chunks, gzip_chunks
+from pool import pool_status
+from instrumentation import instrument, detect_n_plus_one, debug_endpoints_enabled
 
 QUESTIONS_PER_PAGE = 10
+BULK_CHUNK_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+QUIZ_SESSION_TTL = int(os.environ.get('QUIZ_SESSION_TTL', 3600))
+QUIZ_SESSION_MAX = int(os.environ.get('QUIZ_SESSION_MAX', 10000))
+# 'database' (every worker sees every session) or 'memory' (one worker only)
+QUIZ_SESSION_BACKEND = os.environ.get('QUIZ_SESSION_BACKEND', 'database')
+QUIZ_SESSION_BACKENDS = ('database', 'memory')
+
+'''
+Opaque keyset cursors, the client just hands back what it was given.
+'''
+def encode_cursor(question_id):
+  return base64.urlsafe_b64encode(str(question_id).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+  padded = cursor + '=' * (-len(cursor) % 4)
+  return int(base64.urlsafe_b64decode(padded.encode()).decode())
+
+'''
+paginated_questions(request, query)
+    pages through a Question.projection() query in the database instead
+    of in Python.
+    An `after` cursor switches to keyset paging (id > cursor) which stays
+    O(page size) however deep the client goes, otherwise `page` becomes
+    LIMIT/OFFSET. Returns the page and the cursor of the next one.
+'''
+def paginated_questions(request, query):
+  query = query.order_by(Question.id)
+  after = request.args.get('after')
+  if after is not None:
+    try:
+      last_id = decode_cursor(after)
+    except (ValueError, UnicodeDecodeError):
+      abort(422)
+    query = query.filter(Question.id > last_id)
+  else:
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      abort(404)
+    query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+  questions = query.limit(QUESTIONS_PER_PAGE).all()
+  next_cursor = None
+  if len(questions) == QUESTIONS_PER_PAGE:
+    next_cursor = encode_cursor(questions[-1].id)
+
+  return questions, next_cursor
+
+'''
+conditional(*tables)
+    decorator for read endpoints. Their ETag is derived from the highest
+    question id and the version counters of `tables`, which every write
+    bumps, so a matching If-None-Match is answered with a 304 before the
+    view runs any of its queries. The caches of `tables` are synced to the
+    versions read, so the body is never older than its tag.
+'''
+def conditional(*tables):
+  def conditional_decorator(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+      versions = table_versions(tables)
+      for name, version in zip(tables, versions):
+        cache.sync(name, version)
+      fingerprint = '{}|{}|{}'.format(request.full_path, question_max_id(), versions)
+      etag = hashlib.sha1(fingerprint.encode()).hexdigest()
+      if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+      else:
+        response = make_response(f(*args, **kwargs))
+        if response.status_code != 200:
+          return response
+      response.set_etag(etag)
+      return response
 
-def paginated_questions(request, questions):
-  page = int(request.args.get('page', 1))
-  start = (page - 1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
-
-  return questions[start:end]
-
-  
-
-  return 
+    return wrapper
+  return conditional_decorator
 
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  if test_config is not None:
+    app.config.update(test_config)
+  setup_db(app, app.config.get('DATABASE_URL', database_path))
+  # Server-Timing on every response, histograms on /metrics
+  instrument(app)
+  if app.debug:
+    detect_n_plus_one(app)
+
+  '''
+  Categories barely ever change, keep the {id: type} map in the process.
+  Category.insert/update/delete bump its version and invalidate it.
+  '''
+  def load_categories():
+    return {category.id: category.type for category in Category.query.all()}
+
+  category_cache = VersionedCache('categories', load_categories,
+    lambda: cache_version('categories'))
+
+  question_search = QuestionSearch(QUESTIONS_PER_PAGE)
+  quiz_sampler = QuizSampler()
+  quiz_sessions = app.config.get('QUIZ_SESSION_STORE')
+  if quiz_sessions is None:
+    backend = app.config.get('QUIZ_SESSION_BACKEND', QUIZ_SESSION_BACKEND)
+    if backend not in QUIZ_SESSION_BACKENDS:
+      raise ValueError('QUIZ_SESSION_BACKEND must be one of {}, not {!r}'.format(', '.join(QUIZ_SESSION_BACKENDS), backend))
+    if backend == 'memory':
+      quiz_sessions = MemorySessionStore(QUIZ_SESSION_TTL, QUIZ_SESSION_MAX)
+    else:
+      quiz_sessions = DatabaseSessionStore(QUIZ_SESSION_TTL)
   
   '''
   @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -38,7 +140,7 @@ def create_app(test_config=None):
   '''
   @app.after_request
   def after_request(response):
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-DB-Primary-Until,true')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
 
     return response
@@ -49,21 +151,28 @@ def create_app(test_config=None):
   for all available categories.
   '''
   @app.route('/categories')
+  @conditional('categories', 'questions')
   def get_cats():
-    cats = []
-    formated_cats = []
+    formated_cats = {}
     try:
-      cats = Category.query.all()
+      formated_cats = category_cache.get()
     except: 
       abort(404)
 
-    if 0 < len(cats):
-      formated_cats = {category.id: category.type for category in cats}
+    body = {
+      "categories": formated_cats
+    }
 
+    # ?with_counts=1 adds the number of questions of every category,
+    # read from the maintained counters in one small query
+    if request.args.get('with_counts') in ('1', 'true'):
+      try:
+        counts = category_counts()
+      except:
+        abort(404)
+      body["counts"] = {cat_id: counts.get(cat_id, 0) for cat_id in formated_cats}
 
-    return jsonify({
-      "categories": formated_cats
-    })
+    return jsonify(body)
 
   '''
   @TODO: 
@@ -78,36 +187,45 @@ def create_app(test_config=None):
   Clicking on the page numbers should update the questions. 
   '''
   @app.route('/questions')
+  @conditional('questions', 'categories')
   def get_questions():
-    cats = []
-    questions = []
     formatted_categories = {}
     try:
-      cats = Category.query.all()
+      formatted_categories = category_cache.get()
     except: 
       abort(404)
 
-    if 0 < len(cats):
-      formatted_categories = {category.id: category.type for category in cats}
-    
-    try:
-      questions = Question.query.order_by(Question.id).all()
-    except: 
-      abort(404)
-    
-    paginated_qs = paginated_questions(request, questions)
+    paginated_qs, next_cursor = paginated_questions(request, Question.projection())
     if 0 == len(paginated_qs):
       abort(404)
 
-    formated = [q.format() for q in paginated_qs]
-    
+    formated = [Question.format_row(row) for row in paginated_qs]
+
     return jsonify({
       "questions": formated,
-      "total_questions": len(questions),
+      "total_questions": question_count(),
+      "next_cursor": next_cursor,
       "current_category": None,
       "categories": formatted_categories
     })
 
+  '''
+  Streams the whole question bank as NDJSON, one question per line, read
+  EXPORT_BATCH_SIZE rows at a time. Gzipped when the client accepts it.
+  '''
+  @app.route('/questions/export')
+  def export_questions():
+    chunks = ndjson_chunks(Question.stream_batches(EXPORT_BATCH_SIZE))
+    headers = {
+      'Content-Disposition': 'attachment; filename=questions.ndjson',
+      'Vary': 'Accept-Encoding',
+    }
+    if 'gzip' in request.accept_encodings:
+      chunks = gzip_chunks(chunks)
+      headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), mimetype='application/x-ndjson', headers=headers)
+
   '''
   @TODO: 
   Create an endpoint to DELETE question using a question ID. 
@@ -117,20 +235,40 @@ def create_app(test_config=None):
   '''
   @app.route('/questions/<int:id>', methods=["DELETE"])
   def delete_question(id):
-    question = Question.query.filter(Question.id == id).one_or_none()
-    
-    if question is None:
-      abort(422)
     try:
-      question.delete()
+      deleted = Question.bulk_delete(ids=[id])
     except:
       abort(422)
 
+    if not deleted:
+      abort(422)
+
     return jsonify({
       "success": True,
       "deleted": id
     })
 
+  '''
+  Bulk delete: every question matching the given ids and/or category and
+  difficulty, in a single DELETE statement.
+  '''
+  @app.route('/questions', methods=["DELETE"])
+  def bulk_delete_questions():
+    try:
+      criteria = delete_criteria(request.get_json(silent=True))
+    except ValueError:
+      abort(422)
+
+    try:
+      deleted = Question.bulk_delete(**criteria)
+    except:
+      abort(422)
+
+    return jsonify({
+      "success": True,
+      "deleted_count": deleted
+    })
+
   '''
   @TODO: 
   Create an endpoint to POST a new question, 
@@ -147,6 +285,11 @@ def create_app(test_config=None):
   It should return any questions for whom the search term 
   is a substring of the question. 
 
+  Searching goes through QuestionSearch (search.py): full-text on
+  Postgres, an in-process inverted index otherwise. Every word of the
+  term must prefix a word of the question, best matches first, paged
+  by the optional "page" field.
+
   TEST: Search by any phrase. The questions list will update to include 
   only question that include that string within their question. 
   Try using the word "title" to start. 
@@ -162,11 +305,17 @@ def create_app(test_config=None):
     
     if "searchTerm" in data:
       try:
-        questions = Question.query.filter(Question.question.ilike("%{}%".format(data["searchTerm"])))
-        questions = [q.format() for q in questions]
+        page = int(data.get("page", 1))
+      except (TypeError, ValueError):
+        abort(422)
+      if page < 1:
+        abort(422)
+
+      try:
+        questions, total = question_search.search(data["searchTerm"], page)
         body = {
-          "questions": questions,
-          "totalQuestions": len(questions),
+          "questions": [Question.format_row(row) for row in questions],
+          "totalQuestions": total,
           "currentCategory": None
         }
       except:
@@ -193,6 +342,44 @@ def create_app(test_config=None):
 
     return jsonify(body)
 
+  '''
+  Bulk import: a JSON array or an NDJSON stream of questions, inserted in
+  batches within one transaction. Invalid rows are skipped and reported
+  by their position (array index or line number, from 1).
+  '''
+  @app.route('/questions/bulk', methods=["POST"])
+  def bulk_import_questions():
+    try:
+      category_ids = set(category_cache.get())
+    except:
+      abort(422)
+
+    # the whole upload is read and validated before the transaction
+    # opens, a slow client must not hold a connection
+    errors = []
+    valid = []
+    try:
+      for position, row in read_rows(request):
+        values, error = validate_question(row, category_ids)
+        if error is None:
+          valid.append(values)
+        else:
+          errors.append({"row": position, "error": error})
+    except ValueError:
+      abort(422)
+
+    try:
+      inserted = Question.bulk_insert(valid, chunk_size=BULK_CHUNK_SIZE)
+    except:
+      app.logger.exception('bulk import failed')
+      abort(422)
+
+    return jsonify({
+      "success": not errors,
+      "inserted": inserted,
+      "errors": errors
+    })
+
   '''
   @TODO: 
   Create a GET endpoint to get questions based on category. 
@@ -202,10 +389,11 @@ def create_app(test_config=None):
   category to be shown. 
   '''
   @app.route('/categories/<int:cat_id>/questions')
+  @conditional('questions')
   def get_by_cat(cat_id):
     questions = []
     try:
-      questions = Question.query.filter(Question.category == '{}'.format(cat_id)).all()
+      questions = Question.projection().filter(Question.category == cat_id).order_by(Question.id).all()
     except: 
       print(sys.exc_info())
       abort(404)
@@ -213,7 +401,7 @@ def create_app(test_config=None):
     if 0 == len(questions):
       abort(404)
 
-    formated = [q.format() for q in questions]
+    formated = [Question.format_row(row) for row in questions]
     
     return jsonify({
       "questions": formated,
@@ -242,32 +430,21 @@ def create_app(test_config=None):
     if data is None or not len(data):
       abort(422)
 
+    if "session_id" in data:
+      return play_quiz_session(data["session_id"])
+
     # Check if the request doesn't have the arguments and abort if not.
     if "previous_questions" not in data and "quiz_category" not in data:
       abort(422)
 
-    questions = []
-    previous_questions = []
-
     try:
       quiz_cat_id = int(data["quiz_category"]["id"])
-      previous_questions = data["previous_questions"]
-      if quiz_cat_id:
-        questions = Question.query.filter(Question.category == quiz_cat_id).all()
-      else:
-        questions = Question.query.all()
+      previous_questions = set(int(q_id) for q_id in data["previous_questions"])
     except:
       abort(422)
 
-    formated_questions = [q.format() for q in questions]
-    eligible_questions = []
-    for q in formated_questions:
-      if q["id"] not in previous_questions:
-        eligible_questions.append(q["id"])
-    
-    if 0 < len(eligible_questions):
-      choosen_question_id = random.choice(eligible_questions)
-      choosen_question = Question.query.filter(Question.id == choosen_question_id).one_or_none()
+    choosen_question = quiz_sampler.next_question(quiz_cat_id, previous_questions)
+    if choosen_question is not None:
       body = {
         "question": choosen_question.format()
       }
@@ -275,10 +452,63 @@ def create_app(test_config=None):
       body = {
         "question": None
       }
-    
 
     return jsonify(body)
 
+  '''
+  Quiz sessions: instead of sending every previous question on each turn
+  the client starts a session and then only sends its id to /quizzes.
+  The questions played are tracked server side in a SeenSet.
+  '''
+  @app.route('/quizzes/sessions', methods=["POST"])
+  def start_quiz_session():
+    data = request.get_json()
+
+    # Check if the request was sent empty and abort it.
+    if data is None or "quiz_category" not in data:
+      abort(422)
+
+    try:
+      quiz_cat_id = int(data["quiz_category"]["id"])
+    except:
+      abort(422)
+
+    session = QuizSession(quiz_cat_id)
+    quiz_sessions.save(session)
+
+    return jsonify({
+      "success": True,
+      "session_id": session.id,
+      "quiz_category": quiz_cat_id
+    })
+
+  def play_quiz_session(session_id):
+    session = quiz_sessions.get(session_id)
+    if session is None:
+      abort(404)
+
+    choosen_question = quiz_sampler.next_question(session.category_id, session.seen)
+    body = {
+      "session_id": session.id,
+      "question": None
+    }
+    if choosen_question is not None:
+      session.seen.add(choosen_question.id)
+      body["question"] = choosen_question.format()
+    quiz_sessions.save(session)
+
+    return jsonify(body)
+
+  @app.route('/quizzes/sessions/<session_id>', methods=["DELETE"])
+  def end_quiz_session(session_id):
+    if not quiz_sessions.delete(session_id):
+      abort(404)
+
+    return jsonify({
+      "success": True,
+      "deleted": session_id
+    })
+
   '''
   Create new category endpoint
   '''
@@ -308,6 +538,15 @@ def create_app(test_config=None):
     return jsonify(body)
 
 
+  '''
+  Connection pool introspection: connections checked out, overflow in
+  use, and how long requests waited to get one. Only with debug endpoints.
+  '''
+  if debug_endpoints_enabled(app):
+    @app.route('/debug/pool')
+    def get_pool_status():
+      return jsonify(pool_status(db.engine))
+
   '''
   @TODO: 
   Create error handlers for all expected errors 
@@ -0,0 +1,657 @@
+'''
+Asyncio variant of the trivia API.
+
+create_async_app() serves the same routes and JSON as create_app() on an
+ASGI server, with an async SQLAlchemy engine (asyncpg on Postgres,
+aiosqlite locally), so a slow query no longer holds a worker thread:
+
+    pip install -r requirements-async.txt
+    hypercorn 'flaskr.aio:create_async_app()'
+
+It works on the same tables and cache_versions rows as the sync app and
+reuses its helpers, both can run against one database side by side.
+'''
+import asyncio
+import hashlib
+import json
+import time
+from array import array
+from collections import Counter
+from functools import wraps
+
+from quart import Quart, request, abort, jsonify, make_response
+from sqlalchemy import delete, func, insert, literal_column, select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import cache
+from cache import AsyncVersionedCache
+from models import Question, Category, CacheVersion, CategoryCount, QuizSessionRecord, database_path, db, reset_question_count
+from bulk import NDJSON_MIMETYPES, array_rows, ndjson_row, validate_question, delete_criteria, ndjson_chunk, gzip_compressor
+from pool import engine_options, pool_status
+from instrumentation import debug_endpoints_enabled
+from quiz import ALL_CATEGORIES, SAMPLE_ATTEMPTS, MemorySessionStore, QuizSession, Union, sample_id
+from search import InvertedIndex, SEARCH_CONFIG, prefix_tsquery, search_vector, tokenize
+from flaskr import BULK_CHUNK_SIZE, EXPORT_BATCH_SIZE, QUESTIONS_PER_PAGE, QUIZ_SESSION_TTL, QUIZ_SESSION_MAX, QUIZ_SESSION_BACKEND, QUIZ_SESSION_BACKENDS, decode_cursor, encode_cursor
+
+questions = Question.__table__
+categories = Category.__table__
+versions = CacheVersion.__table__
+counts = CategoryCount.__table__
+session_records = QuizSessionRecord.__table__
+
+ASYNC_DRIVERS = {
+  'postgres': 'postgresql+asyncpg',
+  'postgresql': 'postgresql+asyncpg',
+  'sqlite': 'sqlite+aiosqlite',
+}
+
+'''
+async_database_url(url)
+    the asyncio driver URL for a sync one, postgres://… -> postgresql+asyncpg://…
+'''
+def async_database_url(url):
+  scheme, rest = url.split('://', 1)
+  return '{}://{}'.format(ASYNC_DRIVERS.get(scheme, scheme), rest)
+
+def format_question(row):
+  return {
+    'id': row.id,
+    'question': row.question,
+    'answer': row.answer,
+    'category': row.category,
+    'difficulty': row.difficulty
+  }
+
+
+'''
+Writes run inside the caller's transaction, like their models.py versions.
+'''
+async def increment(conn, table, key, column, delta):
+  key_column = table.primary_key.columns.values()[0]
+  if conn.dialect.name == 'postgresql':
+    statement = postgresql.insert(table).values({key_column.name: key, column: delta})
+    await conn.execute(statement.on_conflict_do_update(
+      index_elements=[key_column], set_={column: table.c[column] + delta}))
+    return
+  result = await conn.execute(update(table).where(key_column == key)
+    .values({column: table.c[column] + delta}))
+  if not result.rowcount:
+    await conn.execute(insert(table).values({key_column.name: key, column: delta}))
+
+async def bump_version(conn, name):
+  await increment(conn, versions, name, 'version', 1)
+
+async def adjust_counts(conn, deltas):
+  for category_id, delta in deltas.items():
+    if category_id is None or not delta:
+      continue
+    if delta > 0:
+      await increment(conn, counts, category_id, 'question_count', delta)
+    else:
+      await conn.execute(update(counts).where(counts.c.category_id == category_id)
+        .values(question_count=counts.c.question_count + delta))
+
+def questions_changed():
+  reset_question_count()
+  cache.invalidate(questions.name)
+
+
+'''
+AsyncDatabaseSessionStore(engine, ttl, purge_interval)
+    quiz.DatabaseSessionStore on the async engine. Same quiz_sessions
+    rows, so a session can move between the sync and async apps as well
+    as between workers.
+'''
+class AsyncDatabaseSessionStore:
+  def __init__(self, engine, ttl=3600, purge_interval=60):
+    self.engine = engine
+    self.ttl = ttl
+    self.purge_interval = purge_interval
+    self._purged_at = 0.0
+
+  async def get(self, session_id):
+    async with self.engine.connect() as conn:
+      data = await conn.scalar(select(session_records.c.data)
+        .where(session_records.c.id == session_id, session_records.c.expires_at > time.time()))
+    if data is None:
+      return None
+    return QuizSession.from_bytes(session_id, bytes(data))
+
+  async def save(self, session):
+    now = time.time()
+    values = {'data': session.to_bytes(), 'expires_at': now + self.ttl}
+    async with self.engine.begin() as conn:
+      if now - self._purged_at >= self.purge_interval:
+        self._purged_at = now
+        await conn.execute(delete(session_records).where(session_records.c.expires_at <= now))
+      # session ids are random, only the session's own turns update its row
+      result = await conn.execute(update(session_records)
+        .where(session_records.c.id == session.id).values(values))
+      if not result.rowcount:
+        await conn.execute(insert(session_records).values(id=session.id, **values))
+
+  async def delete(self, session_id):
+    async with self.engine.begin() as conn:
+      result = await conn.execute(delete(session_records)
+        .where(session_records.c.id == session_id, session_records.c.expires_at > time.time()))
+    return result.rowcount > 0
+
+
+'''
+AwaitableSessionStore(store)
+    a synchronous session store (MemorySessionStore or QUIZ_SESSION_STORE)
+    with the coroutine methods of AsyncDatabaseSessionStore
+'''
+class AwaitableSessionStore:
+  def __init__(self, store):
+    self.store = store
+
+  async def get(self, session_id):
+    return self.store.get(session_id)
+
+  async def save(self, session):
+    self.store.save(session)
+
+  async def delete(self, session_id):
+    return self.store.delete(session_id)
+
+
+def create_async_app(test_config=None):
+  app = Quart(__name__)
+  if test_config is not None:
+    app.config.update(test_config)
+
+  url = app.config.get('DATABASE_URL', database_path)
+  options = engine_options(url)
+  # the async engine brings its own asyncio aware queue pool
+  options.pop('poolclass', None)
+  engine = create_async_engine(async_database_url(url), **options)
+  is_postgres = engine.dialect.name == 'postgresql'
+
+  @app.before_serving
+  async def create_tables():
+    async with engine.begin() as conn:
+      await conn.run_sync(db.metadata.create_all)
+
+  @app.after_serving
+  async def dispose_engine():
+    await engine.dispose()
+
+  @app.after_request
+  async def after_request(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+
+    return response
+
+  async def read_version(name):
+    async with engine.connect() as conn:
+      version = await conn.scalar(select(versions.c.version).where(versions.c.name == name))
+    return version or 0
+
+  async def load_categories():
+    async with engine.connect() as conn:
+      result = await conn.execute(select(categories.c.id, categories.c.type))
+      return {row.id: row.type for row in result}
+
+  async def load_question_count():
+    async with engine.connect() as conn:
+      return await conn.scalar(select(func.count(questions.c.id)))
+
+  async def load_question_ids():
+    ids_by_category = {ALL_CATEGORIES: array('q')}
+    async with engine.connect() as conn:
+      result = await conn.stream(select(questions.c.id, questions.c.category).order_by(questions.c.id))
+      async for question_id, category in result:
+        ids_by_category[ALL_CATEGORIES].append(question_id)
+        if category is not None:
+          ids_by_category.setdefault(category, array('q')).append(question_id)
+    return ids_by_category
+
+  async def load_search_index():
+    async with engine.connect() as conn:
+      result = await conn.execute(select(questions.c.id, questions.c.question))
+      rows = result.all()
+    # tokenizing every question is CPU bound, keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, InvertedIndex, rows)
+
+  category_cache = AsyncVersionedCache('categories', load_categories, lambda: read_version('categories'))
+  count_cache = AsyncVersionedCache('questions', load_question_count, lambda: read_version('questions'))
+  ids_cache = AsyncVersionedCache('questions', load_question_ids, lambda: read_version('questions'))
+  index_cache = AsyncVersionedCache('questions', load_search_index, lambda: read_version('questions'))
+  quiz_sessions = app.config.get('QUIZ_SESSION_STORE')
+  if quiz_sessions is not None:
+    quiz_sessions = AwaitableSessionStore(quiz_sessions)
+  else:
+    backend = app.config.get('QUIZ_SESSION_BACKEND', QUIZ_SESSION_BACKEND)
+    if backend not in QUIZ_SESSION_BACKENDS:
+      raise ValueError('QUIZ_SESSION_BACKEND must be one of {}, not {!r}'.format(', '.join(QUIZ_SESSION_BACKENDS), backend))
+    if backend == 'memory':
+      quiz_sessions = AwaitableSessionStore(MemorySessionStore(QUIZ_SESSION_TTL, QUIZ_SESSION_MAX))
+    else:
+      quiz_sessions = AsyncDatabaseSessionStore(engine, QUIZ_SESSION_TTL)
+
+  '''
+  conditional(*tables)
+      the ETag / If-None-Match handling of the sync app, same tags
+  '''
+  def conditional(*tables):
+    def conditional_decorator(f):
+      @wraps(f)
+      async def wrapper(*args, **kwargs):
+        async with engine.connect() as conn:
+          max_id = await conn.scalar(select(func.max(questions.c.id))) or 0
+          result = await conn.execute(select(versions.c.name, versions.c.version)
+            .where(versions.c.name.in_(tables)))
+          table_versions = dict(result.all())
+        stamps = [table_versions.get(name, 0) for name in tables]
+        # the body must not come from caches older than the tag
+        for name, version in zip(tables, stamps):
+          cache.sync(name, version)
+        fingerprint = '{}|{}|{}'.format(request.full_path, max_id, stamps)
+        etag = hashlib.sha1(fingerprint.encode()).hexdigest()
+
+        if request.if_none_match.contains(etag):
+          response = await make_response('', 304)
+        else:
+          response = await make_response(await f(*args, **kwargs))
+          if response.status_code != 200:
+            return response
+        response.set_etag(etag)
+        return response
+
+      return wrapper
+    return conditional_decorator
+
+  @app.route('/categories')
+  @conditional('categories', 'questions')
+  async def get_cats():
+    formated_cats = await category_cache.get()
+    body = {
+      "categories": formated_cats
+    }
+
+    if request.args.get('with_counts') in ('1', 'true'):
+      async with engine.connect() as conn:
+        result = await conn.execute(select(counts.c.category_id, counts.c.question_count))
+        category_counts = dict(result.all())
+      body["counts"] = {cat_id: category_counts.get(cat_id, 0) for cat_id in formated_cats}
+
+    return jsonify(body)
+
+  @app.route('/questions')
+  @conditional('questions', 'categories')
+  async def get_questions():
+    formatted_categories = await category_cache.get()
+
+    query = select(questions).order_by(questions.c.id).limit(QUESTIONS_PER_PAGE)
+    after = request.args.get('after')
+    if after is not None:
+      try:
+        last_id = decode_cursor(after)
+      except (ValueError, UnicodeDecodeError):
+        abort(422)
+      query = query.where(questions.c.id > last_id)
+    else:
+      page = request.args.get('page', 1, type=int)
+      if page < 1:
+        abort(404)
+      query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    async with engine.connect() as conn:
+      rows = (await conn.execute(query)).all()
+    if 0 == len(rows):
+      abort(404)
+
+    next_cursor = None
+    if len(rows) == QUESTIONS_PER_PAGE:
+      next_cursor = encode_cursor(rows[-1].id)
+
+    return jsonify({
+      "questions": [format_question(row) for row in rows],
+      "total_questions": await count_cache.get(),
+      "next_cursor": next_cursor,
+      "current_category": None,
+      "categories": formatted_categories
+    })
+
+  @app.route('/questions/export')
+  async def export_questions():
+    compress = 'gzip' in request.accept_encodings
+
+    async def chunks():
+      compressor = gzip_compressor() if compress else None
+      async with engine.connect() as conn:
+        result = await conn.stream(select(questions).order_by(questions.c.id))
+        async for rows in result.partitions(EXPORT_BATCH_SIZE):
+          chunk = ndjson_chunk([format_question(row) for row in rows])
+          if compressor is not None:
+            chunk = compressor.compress(chunk)
+          if chunk:
+            yield chunk
+      if compressor is not None:
+        yield compressor.flush()
+
+    headers = {
+      'Content-Disposition': 'attachment; filename=questions.ndjson',
+      'Vary': 'Accept-Encoding',
+    }
+    if compress:
+      headers['Content-Encoding'] = 'gzip'
+    return app.response_class(chunks(), mimetype='application/x-ndjson', headers=headers)
+
+  async def delete_matching(*criteria):
+    async with engine.begin() as conn:
+      result = await conn.execute(select(questions.c.category, func.count(questions.c.id))
+        .where(*criteria).group_by(questions.c.category))
+      per_category = dict(result.all())
+      deleted = (await conn.execute(delete(questions).where(*criteria))).rowcount
+      if deleted:
+        await adjust_counts(conn, {category: -count for category, count in per_category.items()})
+        await bump_version(conn, questions.name)
+    if deleted:
+      questions_changed()
+    return deleted
+
+  @app.route('/questions/<int:id>', methods=["DELETE"])
+  async def delete_question(id):
+    if not await delete_matching(questions.c.id == id):
+      abort(422)
+
+    return jsonify({
+      "success": True,
+      "deleted": id
+    })
+
+  @app.route('/questions', methods=["DELETE"])
+  async def bulk_delete_questions():
+    try:
+      given = delete_criteria(await request.get_json(silent=True))
+    except ValueError:
+      abort(422)
+
+    criteria = []
+    if "ids" in given:
+      criteria.append(questions.c.id.in_(given["ids"]))
+    if "category" in given:
+      criteria.append(questions.c.category == given["category"])
+    if "difficulty" in given:
+      criteria.append(questions.c.difficulty == given["difficulty"])
+
+    return jsonify({
+      "success": True,
+      "deleted_count": await delete_matching(*criteria)
+    })
+
+  async def search_questions(term, page):
+    offset = (page - 1) * QUESTIONS_PER_PAGE
+    async with engine.connect() as conn:
+      if not tokenize(term):
+        # no words: every question, as QuestionSearch does
+        rows = (await conn.execute(select(questions).order_by(questions.c.id)
+          .offset(offset).limit(QUESTIONS_PER_PAGE))).all()
+        return rows, await count_cache.get()
+
+      if is_postgres:
+        tsquery_text = prefix_tsquery(term)
+        if not tsquery_text:
+          return [], 0
+        tsquery = func.to_tsquery(literal_column("'{}'::regconfig".format(SEARCH_CONFIG)), tsquery_text)
+        match = search_vector.op('@@')(tsquery)
+        total = await conn.scalar(select(func.count(questions.c.id)).where(match))
+        rows = (await conn.execute(select(questions).where(match)
+          .order_by(func.ts_rank(search_vector, tsquery).desc(), questions.c.id)
+          .offset(offset).limit(QUESTIONS_PER_PAGE))).all()
+        return rows, total
+
+      ranked_ids = (await index_cache.get()).search(term)
+      page_ids = ranked_ids[offset:offset + QUESTIONS_PER_PAGE]
+      if not page_ids:
+        return [], len(ranked_ids)
+      by_id = {row.id: row for row in await conn.execute(select(questions).where(questions.c.id.in_(page_ids)))}
+      return [by_id[question_id] for question_id in page_ids if question_id in by_id], len(ranked_ids)
+
+  @app.route('/questions', methods=["POST"])
+  async def handle_post_requestes():
+    data = await request.get_json(silent=True)
+    if data is None or not len(data):
+      abort(422)
+
+    if "searchTerm" in data:
+      try:
+        page = int(data.get("page", 1))
+      except (TypeError, ValueError):
+        abort(422)
+      if page < 1:
+        abort(422)
+
+      rows, total = await search_questions(data["searchTerm"], page)
+      return jsonify({
+        "questions": [format_question(row) for row in rows],
+        "totalQuestions": total,
+        "currentCategory": None
+      })
+
+    if not ("question" in data and "answer" in data and "difficulty" in data and "category" in data):
+      abort(422)
+
+    try:
+      values = {
+        'question': data['question'],
+        'answer': data['answer'],
+        'difficulty': int(data['difficulty']),
+        'category': int(data['category']),
+      }
+      async with engine.begin() as conn:
+        result = await conn.execute(insert(questions).values(**values))
+        question_id = result.inserted_primary_key[0]
+        await adjust_counts(conn, {values['category']: 1})
+        await bump_version(conn, questions.name)
+    except Exception:
+      abort(422)
+    questions_changed()
+
+    return jsonify({
+      "success": True,
+      "question_id": question_id
+    })
+
+  '''
+  request_ndjson_rows()
+      the (line, row) pairs of an NDJSON request body, parsed as its
+      chunks arrive, like bulk.ndjson_rows
+  '''
+  async def request_ndjson_rows():
+    line_number = 0
+    pending = b''
+    async for chunk in request.body:
+      lines = chunk.split(b'\n')
+      lines[0] = pending + lines[0]
+      pending = lines.pop()
+      for line in lines:
+        line_number += 1
+        if line.strip():
+          yield line_number, ndjson_row(line)
+    if pending.strip():
+      yield line_number + 1, ndjson_row(pending)
+
+  @app.route('/questions/bulk', methods=["POST"])
+  async def bulk_import_questions():
+    category_ids = set(await category_cache.get())
+    errors = []
+    valid = []
+    def add_row(position, row):
+      values, error = validate_question(row, category_ids)
+      if error is None:
+        valid.append(values)
+      else:
+        errors.append({"row": position, "error": error})
+
+    # NDJSON is validated line by line as the body arrives, only the
+    # valid rows are kept, not the body
+    if request.mimetype in NDJSON_MIMETYPES:
+      async for position, row in request_ndjson_rows():
+        add_row(position, row)
+    else:
+      try:
+        rows = array_rows(json.loads(await request.get_data() or 'null'))
+      except ValueError:
+        abort(422)
+      for position, row in rows:
+        add_row(position, row)
+
+    if valid:
+      try:
+        async with engine.begin() as conn:
+          for start in range(0, len(valid), BULK_CHUNK_SIZE):
+            await conn.execute(insert(questions), valid[start:start + BULK_CHUNK_SIZE])
+          await adjust_counts(conn, Counter(values['category'] for values in valid))
+          await bump_version(conn, questions.name)
+      except Exception:
+        abort(422)
+      questions_changed()
+
+    return jsonify({
+      "success": not errors,
+      "inserted": len(valid),
+      "errors": errors
+    })
+
+  @app.route('/categories/<int:cat_id>/questions')
+  @conditional('questions')
+  async def get_by_cat(cat_id):
+    async with engine.connect() as conn:
+      rows = (await conn.execute(select(questions).where(questions.c.category == cat_id)
+        .order_by(questions.c.id))).all()
+
+    if 0 == len(rows):
+      abort(404)
+
+    return jsonify({
+      "questions": [format_question(row) for row in rows],
+      "total_questions": len(rows),
+      "current_category": cat_id,
+    })
+
+  async def next_question(category_id, seen):
+    skipped = set()
+    for _ in range(SAMPLE_ATTEMPTS):
+      question_id = sample_id((await ids_cache.get()).get(category_id, ()), Union(seen, skipped))
+      if question_id is None:
+        return None
+      async with engine.connect() as conn:
+        row = (await conn.execute(select(questions).where(questions.c.id == question_id))).first()
+      if row is not None:
+        return row
+      skipped.add(question_id)
+      ids_cache.invalidate()
+    return None
+
+  @app.route('/quizzes', methods=["POST"])
+  async def generate_quize():
+    data = await request.get_json(silent=True)
+    if data is None or not len(data):
+      abort(422)
+
+    if "session_id" in data:
+      session = await quiz_sessions.get(data["session_id"])
+      if session is None:
+        abort(404)
+
+      row = await next_question(session.category_id, session.seen)
+      body = {
+        "session_id": session.id,
+        "question": None
+      }
+      if row is not None:
+        session.seen.add(row.id)
+        body["question"] = format_question(row)
+      await quiz_sessions.save(session)
+      return jsonify(body)
+
+    if "previous_questions" not in data and "quiz_category" not in data:
+      abort(422)
+
+    try:
+      quiz_cat_id = int(data["quiz_category"]["id"])
+      previous_questions = set(int(q_id) for q_id in data["previous_questions"])
+    except (KeyError, TypeError, ValueError):
+      abort(422)
+
+    row = await next_question(quiz_cat_id, previous_questions)
+    return jsonify({
+      "question": format_question(row) if row is not None else None
+    })
+
+  @app.route('/quizzes/sessions', methods=["POST"])
+  async def start_quiz_session():
+    data = await request.get_json(silent=True)
+    if data is None or "quiz_category" not in data:
+      abort(422)
+
+    try:
+      quiz_cat_id = int(data["quiz_category"]["id"])
+    except (KeyError, TypeError, ValueError):
+      abort(422)
+
+    session = QuizSession(quiz_cat_id)
+    await quiz_sessions.save(session)
+
+    return jsonify({
+      "success": True,
+      "session_id": session.id,
+      "quiz_category": quiz_cat_id
+    })
+
+  @app.route('/quizzes/sessions/<session_id>', methods=["DELETE"])
+  async def end_quiz_session(session_id):
+    if not await quiz_sessions.delete(session_id):
+      abort(404)
+
+    return jsonify({
+      "success": True,
+      "deleted": session_id
+    })
+
+  @app.route('/category', methods=["POST"])
+  async def create_cat():
+    data = await request.get_json(silent=True)
+    if data is None or not len(data) or "cat_type" not in data:
+      abort(422)
+
+    try:
+      async with engine.begin() as conn:
+        await conn.execute(insert(categories).values(type=data["cat_type"]))
+        await bump_version(conn, categories.name)
+    except Exception:
+      abort(422)
+    cache.invalidate(categories.name)
+
+    return jsonify({
+      "success": True
+    })
+
+  if debug_endpoints_enabled(app):
+    @app.route('/debug/pool')
+    async def get_pool_status():
+      return jsonify(pool_status(engine.sync_engine))
+
+  @app.errorhandler(404)
+  async def not_found(error):
+    return jsonify({
+      "success": False,
+      "error": 404,
+      "message": "resource was not found"
+    }), 404
+
+  @app.errorhandler(422)
+  async def unprocessable(error):
+    return jsonify({
+      "success": False,
+      "error": 422,
+      "message": "Unprocessable Entity"
+    }), 422
+
+  return app
@@ -0,0 +1,441 @@
+import atexit
+import collections
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import warnings
+
+from flask import Response, g, has_app_context, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# vendored into the other apps: edit the trivia backend's copy and run
+# projects/shared_modules.py --write to regenerate the others
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+
+'''
+Histogram
+    cumulative buckets per label set, in the Prometheus text format
+'''
+class Histogram:
+  def __init__(self, name, description, buckets):
+    self.name = name
+    self.description = description
+    self.buckets = tuple(buckets)
+    self._lock = threading.Lock()
+    self._series = {}
+
+  def observe(self, labels, value):
+    with self._lock:
+      series = self._series.get(labels)
+      if series is None:
+        series = self._series[labels] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          series['counts'][i] += 1
+      series['sum'] += value
+      series['count'] += 1
+
+  def exposition(self):
+    lines = [
+      '# HELP {} {}'.format(self.name, self.description),
+      '# TYPE {} histogram'.format(self.name),
+    ]
+    with self._lock:
+      for labels, series in sorted(self._series.items()):
+        label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels)
+        for bound, count in zip(self.buckets, series['counts']):
+          lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label_text, bound, count))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label_text, series['count']))
+        lines.append('{}_sum{{{}}} {}'.format(self.name, label_text, series['sum']))
+        lines.append('{}_count{{{}}} {}'.format(self.name, label_text, series['count']))
+    return lines
+
+
+'''
+RequestMetrics
+    what the current request spent, kept on flask.g
+'''
+class RequestMetrics:
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.statements = 0
+    self.sql_time = 0.0
+
+
+def current_metrics():
+  if not has_app_context():
+    return None
+  return g.get('request_metrics')
+
+
+'''
+Statement timing. The listeners are installed once on the Engine class, so
+they see every engine whichever setup_db created it and however late.
+Statements run outside of a request are timed but not attributed.
+'''
+_listening = False
+_listening_lock = threading.Lock()
+_statement_hooks = []
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  elapsed = time.perf_counter() - conn.info['query_started'].pop()
+  metrics = current_metrics()
+  if metrics is not None:
+    metrics.statements += 1
+    metrics.sql_time += elapsed
+  for hook in list(_statement_hooks):
+    hook(conn, statement, parameters, elapsed, executemany)
+
+'''
+listen_to_statements()
+    installs the engine listeners, once per process
+'''
+def listen_to_statements():
+  global _listening
+  with _listening_lock:
+    if not _listening:
+      event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+      event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+      _listening = True
+
+
+def current_route():
+  if not has_request_context():
+    return None
+  if request.url_rule is None:
+    return '{} unmatched'.format(request.method)
+  return '{} {}'.format(request.method, request.url_rule.rule)
+
+
+'''
+SlowQueryLog
+    keeps the statements slower than `threshold` seconds in a ring buffer
+    of the last `capacity`, with their parameters, the route that ran them
+    and the plan the database reports for them: EXPLAIN on Postgres
+    (EXPLAIN ANALYZE for SELECTs when `analyze` is set, which runs the
+    query a second time) and EXPLAIN QUERY PLAN on SQLite. The plan is
+    read on a raw cursor of the same connection, inside a SAVEPOINT on
+    Postgres so a failing EXPLAIN can't abort the transaction.
+'''
+class SlowQueryLog:
+  EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+
+  def __init__(self, threshold=0.1, capacity=200, explain=True, analyze=False):
+    self.threshold = threshold
+    self.explain = explain
+    self.analyze = analyze
+    self._lock = threading.Lock()
+    self._records = collections.deque(maxlen=capacity)
+
+  '''
+  from_env()
+      SLOW_QUERY_MS           threshold in milliseconds (unset or negative disables)
+      SLOW_QUERY_LOG_SIZE     records kept (default 200)
+      SLOW_QUERY_EXPLAIN      capture plans (default true)
+      SLOW_QUERY_ANALYZE      EXPLAIN ANALYZE on Postgres (default false)
+      SLOW_QUERY_LOG_FILE     dumped there when the process exits
+  '''
+  @classmethod
+  def from_env(cls):
+    if not os.environ.get('SLOW_QUERY_MS'):
+      return None
+    threshold_ms = float(os.environ['SLOW_QUERY_MS'])
+    if threshold_ms < 0:
+      return None
+    slow_queries = cls(
+      threshold=threshold_ms / 1000,
+      capacity=int(os.environ.get('SLOW_QUERY_LOG_SIZE', 200)),
+      explain=os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() in TRUE_VALUES,
+      analyze=os.environ.get('SLOW_QUERY_ANALYZE', 'false').lower() in TRUE_VALUES)
+    if os.environ.get('SLOW_QUERY_LOG_FILE'):
+      atexit.register(slow_queries.dump, os.environ['SLOW_QUERY_LOG_FILE'])
+    return slow_queries.start()
+
+  def start(self):
+    listen_to_statements()
+    _statement_hooks.append(self.record)
+    return self
+
+  def stop(self):
+    if self.record in _statement_hooks:
+      _statement_hooks.remove(self.record)
+
+  def record(self, conn, statement, parameters, elapsed, executemany):
+    if elapsed < self.threshold:
+      return
+    entry = {
+      'at': datetime.datetime.utcnow().isoformat() + 'Z',
+      'duration_ms': round(elapsed * 1000, 3),
+      'statement': statement,
+      'parameters': _jsonable(parameters),
+      'route': current_route(),
+      'plan': None,
+    }
+    if self.explain and not executemany:
+      entry['plan'] = self._explain(conn, statement, parameters)
+    with self._lock:
+      self._records.append(entry)
+
+  def _explain(self, conn, statement, parameters):
+    verb = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    if verb not in self.EXPLAINABLE:
+      return None
+
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+      prefix = 'EXPLAIN QUERY PLAN '
+    elif dialect == 'postgresql' and self.analyze and verb == 'select':
+      prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    else:
+      prefix = 'EXPLAIN '
+    savepoint = dialect == 'postgresql' and not getattr(conn.connection, 'autocommit', False)
+
+    cursor = conn.connection.cursor()
+    try:
+      if savepoint:
+        cursor.execute('SAVEPOINT slow_query_explain')
+      try:
+        cursor.execute(prefix + statement, parameters)
+        plan = [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+      except Exception as error:
+        plan = ['EXPLAIN failed: {}'.format(error)]
+        if savepoint:
+          cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+      if savepoint:
+        cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+      return plan
+    except Exception as error:
+      return ['EXPLAIN failed: {}'.format(error)]
+    finally:
+      cursor.close()
+
+  def records(self):
+    with self._lock:
+      return list(self._records)
+
+  def clear(self):
+    with self._lock:
+      self._records.clear()
+
+  '''
+  dump(path)
+      writes the records to `path`, one JSON object per line
+  '''
+  def dump(self, path):
+    with open(path, 'w') as f:
+      for entry in self.records():
+        f.write(json.dumps(entry) + '\n')
+
+
+def _jsonable(parameters):
+  if isinstance(parameters, dict):
+    return {str(key): _jsonable(value) for key, value in parameters.items()}
+  if isinstance(parameters, (list, tuple)):
+    return [_jsonable(value) for value in parameters]
+  if parameters is None or isinstance(parameters, (str, int, float, bool)):
+    return parameters
+  return repr(parameters)
+
+
+'''
+normalize_statement(statement)
+    the shape of a statement: literals and bound parameters become ?,
+    IN lists collapse to one element and whitespace to single spaces, so
+    the queries a loop runs for different rows compare equal
+'''
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|:\w+|\$\d+|\?')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_statement(statement):
+  shape = _STRING_LITERAL.sub('?', statement)
+  shape = _PLACEHOLDER.sub('?', shape)
+  shape = _NUMBER_LITERAL.sub('?', shape)
+  shape = _IN_LIST.sub('IN (?)', shape)
+  return _WHITESPACE.sub(' ', shape).strip()
+
+
+class NPlusOneWarning(UserWarning):
+  pass
+
+class NPlusOneError(AssertionError):
+  pass
+
+
+'''
+NPlusOneDetector
+    counts the statements of every request by shape and reports the
+    shapes run more than `threshold` times, the mark of a query issued
+    once per row in a loop. Reports are warnings (NPlusOneWarning, and the
+    app log); with `strict` the request raises NPlusOneError instead, which
+    fails the test that made it. Transaction control statements
+    (SAVEPOINT, COMMIT, ...) are not counted.
+'''
+class NPlusOneDetector:
+  IGNORED = ('savepoint', 'release', 'rollback', 'begin', 'commit')
+
+  def __init__(self, app=None, threshold=5, strict=False):
+    self.threshold = threshold
+    self.strict = strict
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    listen_to_statements()
+    _statement_hooks.append(self._count)
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+    app.extensions['n_plus_one'] = self
+
+  def _before_request(self):
+    g.statement_shapes = collections.Counter()
+
+  def _count(self, conn, statement, parameters, elapsed, executemany):
+    if not has_app_context():
+      return
+    shapes = g.get('statement_shapes')
+    if shapes is None:
+      return
+    verb = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    if verb not in self.IGNORED:
+      shapes[normalize_statement(statement)] += 1
+
+  def _after_request(self, response):
+    shapes = g.pop('statement_shapes', None)
+    if not shapes:
+      return response
+
+    repeated = [(count, shape) for shape, count in shapes.items() if count > self.threshold]
+    if repeated:
+      message = '{} ran the same statement more than {} times:\n{}'.format(
+        current_route(), self.threshold, '\n'.join('  {} x {}'.format(count, shape) for count, shape in sorted(repeated, reverse=True)))
+      if self.strict:
+        raise NPlusOneError(message)
+      warnings.warn(message, NPlusOneWarning)
+    return response
+
+'''
+detect_n_plus_one(app, threshold, strict)
+    the one call that turns the detector on. Defaults come from
+    N_PLUS_ONE_THRESHOLD (5) and N_PLUS_ONE_STRICT (false).
+'''
+def detect_n_plus_one(app, threshold=None, strict=None):
+  if threshold is None:
+    threshold = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+  if strict is None:
+    strict = os.environ.get('N_PLUS_ONE_STRICT', 'false').lower() in TRUE_VALUES
+  return NPlusOneDetector(app, threshold, strict)
+
+
+'''
+Instrumentation
+    per route wall time, SQL statement count and SQL time. Every response
+    gets a Server-Timing header and the histograms are served on /metrics.
+    The slow query log configured from the environment is served on
+    /debug/slow-queries when the app serves debug endpoints.
+'''
+class Instrumentation:
+  def __init__(self, app=None, metrics_path='/metrics'):
+    self.metrics_path = metrics_path
+    self.request_duration = Histogram('http_request_duration_seconds',
+      'Wall time of requests.', DURATION_BUCKETS)
+    self.sql_duration = Histogram('http_request_sql_duration_seconds',
+      'Time spent in SQL statements per request.', DURATION_BUCKETS)
+    self.sql_statements = Histogram('http_request_sql_statements',
+      'SQL statements run per request.', STATEMENT_BUCKETS)
+    self.slow_queries = None
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    listen_to_statements()
+    app.before_request(self._before_request)
+    app.after_request(self._after_request)
+    app.add_url_rule(self.metrics_path, 'metrics', self.metrics)
+    if debug_endpoints_enabled(app):
+      app.add_url_rule('/debug/slow-queries', 'slow_queries', self.slow_query_records)
+    app.extensions['instrumentation'] = self
+    self.slow_queries = shared_slow_query_log()
+
+  def _before_request(self):
+    g.request_metrics = RequestMetrics()
+
+  def _after_request(self, response):
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+      return response
+
+    wall_time = time.perf_counter() - metrics.started
+    response.headers.add('Server-Timing', 'app;dur={:.3f}, db;dur={:.3f};desc="statements={}"'.format(
+      wall_time * 1000, metrics.sql_time * 1000, metrics.statements))
+
+    # label by route pattern, not by path, to keep the series bounded
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if route != self.metrics_path:
+      labels = (('method', request.method), ('route', route), ('status', str(response.status_code)))
+      self.request_duration.observe(labels, wall_time)
+      self.sql_duration.observe(labels, metrics.sql_time)
+      self.sql_statements.observe(labels, metrics.statements)
+    return response
+
+  def metrics(self):
+    lines = []
+    for histogram in (self.request_duration, self.sql_duration, self.sql_statements):
+      lines.extend(histogram.exposition())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+  def slow_query_records(self):
+    if self.slow_queries is None:
+      return jsonify({'threshold_ms': None, 'slow_queries': []})
+    return jsonify({
+      'threshold_ms': self.slow_queries.threshold * 1000,
+      'slow_queries': self.slow_queries.records(),
+    })
+
+
+'''
+shared_slow_query_log()
+    the process wide SlowQueryLog, created from the environment on first use
+'''
+_slow_query_log = None
+_slow_query_log_created = False
+_slow_query_log_lock = threading.Lock()
+
+def shared_slow_query_log():
+  global _slow_query_log, _slow_query_log_created
+  with _slow_query_log_lock:
+    if not _slow_query_log_created:
+      _slow_query_log_created = True
+      _slow_query_log = SlowQueryLog.from_env()
+  return _slow_query_log
+
+
+'''
+debug_endpoints_enabled(app)
+    the /debug routes show SQL with its parameters and the pool's state,
+    they are only served in debug mode or with DEBUG_ENDPOINTS=true (app
+    config key or environment variable)
+'''
+def debug_endpoints_enabled(app):
+  if app.debug:
+    return True
+  enabled = app.config.get('DEBUG_ENDPOINTS', os.environ.get('DEBUG_ENDPOINTS', 'false'))
+  return str(enabled).lower() in TRUE_VALUES
+
+
+def instrument(app, metrics_path='/metrics'):
+  return Instrumentation(app, metrics_path)
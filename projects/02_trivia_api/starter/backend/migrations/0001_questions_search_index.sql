@@ -0,0 +1,10 @@
+-- Full-text search index for POST /questions {"searchTerm": ...}.
+-- search.py matches to_tsvector('english', coalesce(question, '')) against
+-- a prefix tsquery; this GIN index on that exact expression is what keeps
+-- the search off a sequential scan. New databases get it from create_all.
+-- CONCURRENTLY keeps the table writable while the index builds.
+--
+--   psql trivia < migrations/0001_questions_search_index.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_question_tsv ON questions
+    USING gin (to_tsvector('english'::regconfig, coalesce(question, '')));
@@ -0,0 +1,40 @@
+-- questions.category as an indexed integer foreign key to categories.
+--
+-- Works on a database restored from trivia.psql (integer column, FK named
+-- "category") as well as on one created by db.create_all() before this
+-- change (varchar column, no FK, no index). Runs in one transaction so a
+-- failure leaves the table as it was.
+--
+--   psql trivia < migrations/0002_questions_category_fk.sql
+
+BEGIN;
+
+-- Values that don't name an existing category (orphans, or text that
+-- isn't a number) would break the cast or the FK; clear them instead.
+UPDATE questions SET category = NULL
+ WHERE category IS NOT NULL
+   AND NOT EXISTS (
+     SELECT 1 FROM categories c WHERE c.id::text = trim(questions.category::text)
+   );
+
+-- Only rewrite the table when the column isn't an integer already.
+DO $$
+BEGIN
+  IF (SELECT data_type FROM information_schema.columns
+       WHERE table_schema = current_schema()
+         AND table_name = 'questions' AND column_name = 'category') <> 'integer' THEN
+    ALTER TABLE questions
+      ALTER COLUMN category TYPE integer USING trim(category::text)::integer;
+  END IF;
+END
+$$;
+
+ALTER TABLE questions DROP CONSTRAINT IF EXISTS category;
+ALTER TABLE questions DROP CONSTRAINT IF EXISTS questions_category_fkey;
+ALTER TABLE questions
+  ADD CONSTRAINT questions_category_fkey FOREIGN KEY (category)
+  REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL;
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id);
+
+COMMIT;
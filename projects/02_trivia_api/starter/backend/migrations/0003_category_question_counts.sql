@@ -0,0 +1,26 @@
+-- Per category question counters read by GET /categories?with_counts=1.
+-- The app keeps them up to date on every question write; this creates
+-- the table and (re)computes every count from the questions table.
+--
+--   psql trivia < migrations/0003_category_question_counts.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS category_question_counts (
+  category_id integer PRIMARY KEY REFERENCES categories (id) ON DELETE CASCADE,
+  question_count integer NOT NULL DEFAULT 0
+);
+
+-- keep concurrent question writes out until the counts are in place
+LOCK TABLE questions IN SHARE MODE;
+
+INSERT INTO category_question_counts (category_id, question_count)
+SELECT category, count(*) FROM questions
+ WHERE category IS NOT NULL
+ GROUP BY category
+ON CONFLICT (category_id) DO UPDATE SET question_count = EXCLUDED.question_count;
+
+UPDATE category_question_counts SET question_count = 0
+ WHERE category_id NOT IN (SELECT DISTINCT category FROM questions WHERE category IS NOT NULL);
+
+COMMIT;
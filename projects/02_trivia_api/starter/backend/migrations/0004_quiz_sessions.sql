@@ -0,0 +1,17 @@
+-- Quiz sessions shared by every worker, see quiz.DatabaseSessionStore.
+-- db.create_all() creates the table on start as well; this is for
+-- databases managed with migrations only.
+--
+--   psql trivia < migrations/0004_quiz_sessions.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS quiz_sessions (
+  id varchar PRIMARY KEY,
+  data bytea NOT NULL,
+  expires_at double precision NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_quiz_sessions_expires_at ON quiz_sessions (expires_at);
+
+COMMIT;
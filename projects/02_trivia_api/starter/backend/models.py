@@ -1,25 +1,35 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from collections import Counter, namedtuple
+from sqlalchemy import Column, String, Integer, Float, LargeBinary, ForeignKey, Index, create_engine, func, inspect
+from sqlalchemy.dialects import postgresql
 import json
 
+import cache
+from pool import engine_options
+from routing import RoutingSQLAlchemy, init_replicas
+
 database_name = "trivia"
 database_username = 'postgres'
 database_password = 'root'
 database_path = "postgres://{}:{}@{}/{}".format(database_username, database_password, 'localhost:5432', database_name)
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the connection pool is configured from the environment, see pool.engine_options
+    GET requests read from the replicas in DATABASE_REPLICA_URLS, if any, see routing.init_replicas
 '''
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    init_replicas(app)
     db.create_all()
+    backfill_category_counts()
 
 '''
 Question
@@ -27,11 +37,16 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # (category, id) serves both the category filter and the id ordering
+  # and keyset paging of category listings
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
   def __init__(self, question, answer, category, difficulty):
@@ -42,14 +57,145 @@ class Question(db.Model):
 
   def insert(self):
     db.session.add(self)
+    adjust_category_counts({self.category: 1})
+    version = bump_cache_version(self.__tablename__)
+    change = QuestionChange(added=[(self.id, self.category)], removed=[])
     db.session.commit()
+    reset_question_count()
+    cache.apply(self.__tablename__, change, version)
   
   def update(self):
+    change = QuestionChange(added=[], removed=[])
+    history = inspect(self).attrs.category.history
+    if history.deleted and history.added:
+      adjust_category_counts({history.deleted[0]: -1, history.added[0]: 1})
+      change = QuestionChange(added=[(self.id, history.added[0])], removed=[(self.id, history.deleted[0])])
+    elif inspect(self).attrs.question.history.has_changes():
+      # same category, only the search index has to see the new text
+      change = QuestionChange(added=[(self.id, self.category)], removed=[])
+    version = bump_cache_version(self.__tablename__)
     db.session.commit()
+    cache.apply(self.__tablename__, change, version)
 
   def delete(self):
+    change = QuestionChange(added=[], removed=[(self.id, self.category)])
     db.session.delete(self)
+    adjust_category_counts({self.category: -1})
+    version = bump_cache_version(self.__tablename__)
     db.session.commit()
+    reset_question_count()
+    cache.apply(self.__tablename__, change, version)
+
+  '''
+  bulk_insert(rows, chunk_size)
+      inserts an iterable of column dicts with one executemany per chunk,
+      all inside a single transaction. Returns the number of rows inserted;
+      on error nothing is kept and the exception is raised again.
+  '''
+  @classmethod
+  def bulk_insert(cls, rows, chunk_size=1000):
+    inserted = 0
+    chunk = []
+    per_category = Counter()
+    try:
+      for row in rows:
+        chunk.append(row)
+        per_category[row['category']] += 1
+        if len(chunk) == chunk_size:
+          db.session.execute(cls.__table__.insert(), chunk)
+          inserted += len(chunk)
+          chunk = []
+      if chunk:
+        db.session.execute(cls.__table__.insert(), chunk)
+        inserted += len(chunk)
+
+      if inserted:
+        adjust_category_counts(per_category)
+        bump_cache_version(cls.__tablename__)
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+
+    if inserted:
+      reset_question_count()
+      cache.invalidate(cls.__tablename__)
+    return inserted
+
+  '''
+  bulk_delete(ids, category, difficulty)
+      one set based DELETE of the questions matching every criterion
+      given. Refuses to run without any, so it can't empty the table by
+      accident. Returns the number of rows deleted.
+  '''
+  @classmethod
+  def bulk_delete(cls, ids=None, category=None, difficulty=None):
+    criteria = []
+    if ids is not None:
+      criteria.append(cls.id.in_(ids))
+    if category is not None:
+      criteria.append(cls.category == category)
+    if difficulty is not None:
+      criteria.append(cls.difficulty == difficulty)
+    if not criteria:
+      raise ValueError('bulk_delete needs at least one criterion')
+
+    try:
+      per_category = dict(db.session.query(cls.category, func.count(cls.id))
+        .filter(*criteria).group_by(cls.category))
+      deleted = cls.query.filter(*criteria).delete(synchronize_session=False)
+      if deleted:
+        adjust_category_counts({category: -count for category, count in per_category.items()})
+        bump_cache_version(cls.__tablename__)
+      db.session.commit()
+    except:
+      db.session.rollback()
+      raise
+
+    if deleted:
+      reset_question_count()
+      cache.invalidate(cls.__tablename__)
+    return deleted
+
+  '''
+  projection()
+      a query of the format() columns as plain row tuples. No Question
+      instances are built, so list endpoints skip the identity map and
+      attribute instrumentation; serialize the rows with format_row().
+  '''
+  @classmethod
+  def projection(cls):
+    return db.session.query(cls.id, cls.question, cls.answer, cls.category, cls.difficulty)
+
+  @staticmethod
+  def format_row(row):
+    id, question, answer, category, difficulty = row
+    return {
+      'id': id,
+      'question': question,
+      'answer': answer,
+      'category': category,
+      'difficulty': difficulty
+    }
+
+  '''
+  stream_batches(batch_size)
+      every question as format() dicts, `batch_size` at a time in id
+      order. Runs the projection on a server side cursor where the driver
+      has one (stream_results), so memory stays flat whatever the table size.
+  '''
+  @classmethod
+  def stream_batches(cls, batch_size=1000):
+    statement = cls.projection().order_by(cls.id).statement
+    result = db.session.execute(statement.execution_options(stream_results=True))
+    try:
+      while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+          break
+        yield [cls.format_row(row) for row in rows]
+    finally:
+      result.close()
 
   def format(self):
     return {
@@ -60,6 +206,32 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+'''
+QuestionChange
+    the (id, category) pairs a single question write added and removed,
+    handed to the 'questions' caches with cache.apply. A question whose
+    text changed is in `added` again, with the same category.
+'''
+QuestionChange = namedtuple('QuestionChange', 'added removed')
+
+'''
+question_count()
+    total number of questions. COUNT(*) is a full scan on Postgres so the
+    result is a VersionedCache of its own, only counted again after the
+    questions changed.
+'''
+def count_questions():
+  return db.session.query(func.count(Question.id)).scalar()
+
+_question_count = cache.VersionedCache('questions', count_questions,
+  lambda: cache_version('questions'))
+
+def question_count():
+  return _question_count.get()
+
+def reset_question_count():
+  _question_count.invalidate()
+
 '''
 Category
 
@@ -75,17 +247,141 @@ class Category(db.Model):
 
   def insert(self):
     db.session.add(self)
+    bump_cache_version(self.__tablename__)
     db.session.commit()
+    cache.invalidate(self.__tablename__)
   
   def update(self):
+    bump_cache_version(self.__tablename__)
     db.session.commit()
+    cache.invalidate(self.__tablename__)
 
   def delete(self):
     db.session.delete(self)
+    bump_cache_version(self.__tablename__)
     db.session.commit()
+    cache.invalidate(self.__tablename__)
 
   def format(self):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+increment(table, key, column, delta)
+    adds `delta` to `column` of the row of `table` whose primary key is
+    `key`, creating the row with `delta` when there is none yet. On
+    Postgres that's one INSERT ... ON CONFLICT DO UPDATE, so two
+    transactions writing the first row can't both insert it; SQLite lets
+    one writer in at a time, an UPDATE and an INSERT if it matched nothing
+    are enough there.
+'''
+def increment(table, key, column, delta):
+  key_column = table.primary_key.columns.values()[0]
+  # pending objects go first, callers read the ids they get
+  db.session.flush()
+  if db.engine.dialect.name == 'postgresql':
+    statement = postgresql.insert(table).values({key_column.name: key, column: delta})
+    db.session.execute(statement.on_conflict_do_update(
+      index_elements=[key_column], set_={column: table.c[column] + delta}))
+    return
+  updated = db.session.execute(table.update().where(key_column == key)
+    .values({column: table.c[column] + delta})).rowcount
+  if not updated:
+    db.session.execute(table.insert().values({key_column.name: key, column: delta}))
+
+'''
+CacheVersion
+    one counter per cached table, bumped in the same transaction as the
+    change so every worker's VersionedCache (see cache.py) can tell its
+    copy is stale with a primary key lookup.
+'''
+class CacheVersion(db.Model):
+  __tablename__ = 'cache_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+
+'''
+bump_cache_version(name)
+    increments the counter in the current transaction and returns its new
+    value, the row stays locked until the commit so no other writer can
+    bump it in between
+'''
+def bump_cache_version(name):
+  increment(CacheVersion.__table__, name, 'version', 1)
+  return cache_version(name)
+
+def cache_version(name):
+  version = db.session.query(CacheVersion.version).filter(CacheVersion.name == name).scalar()
+  return version or 0
+
+'''
+table_versions(names)
+    the version of every named table, read in one query
+'''
+def table_versions(names):
+  versions = dict(db.session.query(CacheVersion.name, CacheVersion.version)
+    .filter(CacheVersion.name.in_(names)))
+  return [versions.get(name, 0) for name in names]
+
+def question_max_id():
+  return db.session.query(func.max(Question.id)).scalar() or 0
+
+'''
+CategoryCount
+    number of questions per category, kept up to date by every Question
+    write so the category sidebar doesn't have to count the questions
+    table. backfill_category_counts() fills it for databases that have
+    questions but no counts yet (also see migrations/0003).
+'''
+class CategoryCount(db.Model):
+  __tablename__ = 'category_question_counts'
+
+  category_id = Column(Integer, ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+  question_count = Column(Integer, nullable=False, default=0)
+
+'''
+adjust_category_counts(deltas)
+    applies {category_id: delta} to the counters, in the caller's
+    transaction. A category's first question creates its counter, see
+    increment
+'''
+def adjust_category_counts(deltas):
+  for category_id, delta in deltas.items():
+    if category_id is None or not delta:
+      continue
+    if delta > 0:
+      increment(CategoryCount.__table__, category_id, 'question_count', delta)
+    else:
+      CategoryCount.query.filter(CategoryCount.category_id == category_id).update(
+        {CategoryCount.question_count: CategoryCount.question_count + delta}, synchronize_session=False)
+
+def category_counts():
+  return dict(db.session.query(CategoryCount.category_id, CategoryCount.question_count))
+
+def backfill_category_counts():
+  if db.session.query(CategoryCount.category_id).first() is not None:
+    return
+  if db.session.query(Question.id).first() is None:
+    return
+
+  counts = db.session.query(Question.category, func.count(Question.id)) \
+    .filter(Question.category.isnot(None)).group_by(Question.category)
+  db.session.add_all(CategoryCount(category_id=category_id, question_count=count)
+                     for category_id, count in counts)
+  db.session.commit()
+
+'''
+QuizSessionRecord
+    a quiz session in progress, QuizSession.to_bytes() and the time.time()
+    after which it's gone, so every worker can play it. See
+    quiz.DatabaseSessionStore (also see migrations/0004).
+'''
+class QuizSessionRecord(db.Model):
+  __tablename__ = 'quiz_sessions'
+
+  id = Column(String, primary_key=True)
+  data = Column(LargeBinary, nullable=False)
+  expires_at = Column(Float, nullable=False, index=True)
@@ -0,0 +1,324 @@
+import random
+import secrets
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from models import db, Question, QuizSessionRecord, cache_version
+from cache import VersionedCache
+
+ALL_CATEGORIES = 0
+SAMPLE_ATTEMPTS = 16
+
+'''
+QuizSampler
+    picks a random question for /quizzes without loading the category.
+    Keeps a sorted array of question ids per category (and one of every
+    id for "All"), versioned like the other caches. Inserts, deletes and
+    category changes made through this process are applied to the arrays
+    in place, a write by another worker rebuilds them. A pick draws random positions and skips the ones
+    already seen; that is O(1) expected while the player has seen less
+    than most of the category, and only once nearly everything is seen
+    does it fall back to filtering the array.
+'''
+class QuizSampler:
+  def __init__(self):
+    self.ids_cache = VersionedCache('questions', self._load_ids,
+      lambda: cache_version('questions'), updater=self._apply_change)
+
+  def _load_ids(self):
+    ids_by_category = {ALL_CATEGORIES: array('q')}
+    rows = db.session.query(Question.id, Question.category).order_by(Question.id).yield_per(5000)
+    for question_id, category in rows:
+      ids_by_category[ALL_CATEGORIES].append(question_id)
+      if category is not None:
+        ids_by_category.setdefault(category, array('q')).append(question_id)
+    return ids_by_category
+
+  '''
+  _apply_change(ids_by_category, change)
+      patches the arrays with a models.QuestionChange. Readers keep
+      sampling the same arrays meanwhile, see sample_id.
+  '''
+  def _apply_change(self, ids_by_category, change):
+    for question_id, category in change.removed:
+      remove_id(ids_by_category[ALL_CATEGORIES], question_id)
+      if category in ids_by_category:
+        remove_id(ids_by_category[category], question_id)
+    for question_id, category in change.added:
+      insert_id(ids_by_category[ALL_CATEGORIES], question_id)
+      if category is not None:
+        insert_id(ids_by_category.setdefault(category, array('q')), question_id)
+
+  '''
+  sample(category_id, seen)
+      a random question id of the category that is not in `seen`, which
+      only has to support `in`. None when the category is exhausted.
+  '''
+  def sample(self, category_id, seen):
+    return sample_id(self.ids_cache.get().get(category_id, ()), seen)
+
+  '''
+  next_question(category_id, seen)
+      the Question to play next, or None. The ids can be a few seconds
+      behind deletes made by other workers, a vanished id is skipped.
+  '''
+  def next_question(self, category_id, seen):
+    skipped = set()
+    for _ in range(SAMPLE_ATTEMPTS):
+      question_id = self.sample(category_id, Union(seen, skipped))
+      if question_id is None:
+        return None
+      question = Question.query.get(question_id)
+      if question is not None:
+        return question
+      skipped.add(question_id)
+      self.ids_cache.invalidate()
+    return None
+
+
+'''
+insert_id(ids, question_id) / remove_id(ids, question_id)
+    keep a sorted array sorted, both are no-ops when there is nothing to do
+'''
+def insert_id(ids, question_id):
+  position = bisect_left(ids, question_id)
+  if position == len(ids) or ids[position] != question_id:
+    ids.insert(position, question_id)
+
+def remove_id(ids, question_id):
+  position = bisect_left(ids, question_id)
+  if position < len(ids) and ids[position] == question_id:
+    del ids[position]
+
+
+'''
+sample_id(ids, seen)
+    random draws with rejection, see QuizSampler. The array may shrink
+    under a draw when another thread applies a delete, that draw is
+    just retried.
+'''
+def sample_id(ids, seen):
+  if not ids:
+    return None
+
+  for _ in range(SAMPLE_ATTEMPTS):
+    try:
+      candidate = ids[random.randrange(len(ids))]
+    except (IndexError, ValueError):
+      continue
+    if candidate not in seen:
+      return candidate
+
+  remaining = [question_id for question_id in ids if question_id not in seen]
+  if not remaining:
+    return None
+  return random.choice(remaining)
+
+
+class Union:
+  def __init__(self, *sets):
+    self.sets = sets
+
+  def __contains__(self, item):
+    return any(item in s for s in self.sets)
+
+
+'''
+SeenSet
+    compact set of question ids for quiz sessions, laid out like a
+    roaring bitmap: ids are split into 65536 wide chunks by their high
+    bits, a chunk holds its low bits in a sorted array of uint16 (2 bytes
+    per id, searched with bisect) until it has ARRAY_LIMIT members and
+    then switches to an 8KB bitmap. `in` is O(log n) on an array chunk and
+    O(1) on a bitmap, and memory follows the number of ids seen, not the
+    largest id.
+'''
+class SeenSet:
+  CHUNK_BITS = 16
+  CHUNK_MASK = (1 << CHUNK_BITS) - 1
+  BITMAP_BYTES = (1 << CHUNK_BITS) // 8
+  ARRAY_LIMIT = 4096
+
+  def __init__(self):
+    self.chunks = {}
+    self.size = 0
+
+  def add(self, question_id):
+    high, low = question_id >> self.CHUNK_BITS, question_id & self.CHUNK_MASK
+    chunk = self.chunks.get(high)
+    if chunk is None:
+      chunk = self.chunks[high] = array('H')
+
+    if isinstance(chunk, array):
+      position = bisect_left(chunk, low)
+      if position < len(chunk) and chunk[position] == low:
+        return
+      chunk.insert(position, low)
+      if len(chunk) >= self.ARRAY_LIMIT:
+        self.chunks[high] = self._to_bitmap(chunk)
+    else:
+      byte, bit = low >> 3, 1 << (low & 7)
+      if chunk[byte] & bit:
+        return
+      chunk[byte] |= bit
+    self.size += 1
+
+  def __contains__(self, question_id):
+    chunk = self.chunks.get(question_id >> self.CHUNK_BITS)
+    if chunk is None:
+      return False
+    low = question_id & self.CHUNK_MASK
+    if isinstance(chunk, array):
+      position = bisect_left(chunk, low)
+      return position < len(chunk) and chunk[position] == low
+    return bool(chunk[low >> 3] & (1 << (low & 7)))
+
+  def __len__(self):
+    return self.size
+
+  def _to_bitmap(self, lows):
+    bitmap = bytearray(self.BITMAP_BYTES)
+    for low in lows:
+      bitmap[low >> 3] |= 1 << (low & 7)
+    return bitmap
+
+  '''
+  to_bytes() / from_bytes(data)
+      serialized form for session stores that keep bytes. Per chunk: the
+      high bits and a member count, then either the low bits as uint16s or
+      the raw bitmap.
+  '''
+  def to_bytes(self):
+    parts = [struct.pack('>I', self.size)]
+    for high, chunk in self.chunks.items():
+      if isinstance(chunk, array):
+        parts.append(struct.pack('>IBH', high, 0, len(chunk)))
+        parts.append(struct.pack('>{}H'.format(len(chunk)), *chunk))
+      else:
+        parts.append(struct.pack('>IBH', high, 1, 0))
+        parts.append(bytes(chunk))
+    return b''.join(parts)
+
+  @classmethod
+  def from_bytes(cls, data):
+    seen = cls()
+    seen.size, = struct.unpack_from('>I', data, 0)
+    offset = 4
+    while offset < len(data):
+      high, kind, count = struct.unpack_from('>IBH', data, offset)
+      offset += 7
+      if kind == 0:
+        seen.chunks[high] = array('H', struct.unpack_from('>{}H'.format(count), data, offset))
+        offset += 2 * count
+      else:
+        seen.chunks[high] = bytearray(data[offset:offset + cls.BITMAP_BYTES])
+        offset += cls.BITMAP_BYTES
+    return seen
+
+
+'''
+QuizSession
+    a game in progress: its category and the questions already played.
+'''
+class QuizSession:
+  def __init__(self, category_id, session_id=None, seen=None):
+    self.id = session_id or secrets.token_urlsafe(16)
+    self.category_id = category_id
+    self.seen = seen if seen is not None else SeenSet()
+
+  def to_bytes(self):
+    return struct.pack('>q', self.category_id) + self.seen.to_bytes()
+
+  @classmethod
+  def from_bytes(cls, session_id, data):
+    category_id, = struct.unpack_from('>q', data, 0)
+    return cls(category_id, session_id, SeenSet.from_bytes(data[8:]))
+
+
+'''
+MemorySessionStore
+    quiz sessions that live in this process and expire `ttl` seconds
+    after their last turn. At most `max_sessions` are kept, past that the
+    least recently played ones are dropped. Only for a single worker: a
+    session started on one process is a 404 on every other, so servers
+    running several use DatabaseSessionStore (QUIZ_SESSION_BACKEND).
+    Another backend (redis, memcached) only needs get/save/delete and can
+    persist QuizSession.to_bytes(); pass it as QUIZ_SESSION_STORE in the
+    app config.
+'''
+class MemorySessionStore:
+  def __init__(self, ttl=3600, max_sessions=10000):
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    self._sessions = OrderedDict()
+    self._lock = threading.Lock()
+
+  def _evict(self, now):
+    # least recently used first, so expired sessions are always at the front
+    while self._sessions:
+      session_id, (expires_at, _) = next(iter(self._sessions.items()))
+      if expires_at > now:
+        break
+      del self._sessions[session_id]
+
+  def get(self, session_id):
+    now = time.monotonic()
+    with self._lock:
+      self._evict(now)
+      entry = self._sessions.get(session_id)
+      if entry is None:
+        return None
+      return entry[1]
+
+  def save(self, session):
+    now = time.monotonic()
+    with self._lock:
+      self._evict(now)
+      self._sessions[session.id] = (now + self.ttl, session)
+      self._sessions.move_to_end(session.id)
+      while len(self._sessions) > self.max_sessions:
+        self._sessions.popitem(last=False)
+
+  def delete(self, session_id):
+    with self._lock:
+      return self._sessions.pop(session_id, None) is not None
+
+
+'''
+DatabaseSessionStore
+    the default quiz session store, sessions are QuizSessionRecord rows
+    that every worker reads. A turn is one primary key read and one
+    write; sessions expire `ttl` seconds after their last turn and the
+    expired rows are deleted at most every `purge_interval` seconds.
+'''
+class DatabaseSessionStore:
+  def __init__(self, ttl=3600, purge_interval=60):
+    self.ttl = ttl
+    self.purge_interval = purge_interval
+    self._purged_at = 0.0
+
+  def get(self, session_id):
+    data = db.session.query(QuizSessionRecord.data) \
+      .filter(QuizSessionRecord.id == session_id, QuizSessionRecord.expires_at > time.time()).scalar()
+    if data is None:
+      return None
+    return QuizSession.from_bytes(session_id, bytes(data))
+
+  def save(self, session):
+    now = time.time()
+    if now - self._purged_at >= self.purge_interval:
+      self._purged_at = now
+      QuizSessionRecord.query.filter(QuizSessionRecord.expires_at <= now).delete(synchronize_session=False)
+    db.session.merge(QuizSessionRecord(id=session.id, data=session.to_bytes(), expires_at=now + self.ttl))
+    db.session.commit()
+
+  def delete(self, session_id):
+    deleted = QuizSessionRecord.query \
+      .filter(QuizSessionRecord.id == session_id, QuizSessionRecord.expires_at > time.time()) \
+      .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted > 0
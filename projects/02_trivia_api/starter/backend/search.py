@@ -0,0 +1,204 @@
+import bisect
+import math
+import re
+
+from sqlalchemy import DDL, event, func, literal_column
+
+from models import db, Question, cache_version, question_count
+from cache import VersionedCache
+from routing import on_primary
+
+SEARCH_CONFIG = 'english'
+TOKEN_PATTERN = re.compile(r'\w+')
+
+'''
+On Postgres questions are matched against to_tsvector(question), backed by
+a GIN index on that same expression. The index is created along with the
+table here; existing databases get it from migrations/0001_questions_search_index.sql.
+The expression below has to stay identical to the indexed one or the
+planner falls back to a sequential scan.
+'''
+search_vector = func.to_tsvector(
+  literal_column("'{}'::regconfig".format(SEARCH_CONFIG)),
+  func.coalesce(Question.question, literal_column("''")))
+
+event.listen(Question.__table__, 'after_create', DDL(
+  "CREATE INDEX IF NOT EXISTS ix_questions_question_tsv ON questions "
+  "USING gin (to_tsvector('{}'::regconfig, coalesce(question, '')))".format(SEARCH_CONFIG)
+).execute_if(dialect='postgresql'))
+
+
+def tokenize(text):
+  return TOKEN_PATTERN.findall((text or '').lower())
+
+def term_frequencies(text):
+  frequencies = {}
+  for term in tokenize(text):
+    frequencies[term] = frequencies.get(term, 0) + 1
+  return frequencies
+
+r'''
+prefix_tsquery(term)
+    every word of the search term has to match the start of a word,
+    "tom han" -> "tom:* & han:*". Words are \w+ only so nothing in the
+    term can inject tsquery operators.
+'''
+def prefix_tsquery(term):
+  return ' & '.join('{}:*'.format(word) for word in tokenize(term))
+
+
+'''
+InvertedIndex
+    the in-process fallback used on SQLite and in tests.
+    Maps every term to {question_id: term frequency}; terms are also kept
+    sorted so a prefix is a bisect plus a short scan. Results are ranked
+    by tf-idf, with the same "every word is a prefix" semantics as the
+    Postgres query. add() and remove() patch it for a single question;
+    they replace the postings and the term list they change instead of
+    mutating them, so searches running meanwhile see either version.
+'''
+class InvertedIndex:
+  def __init__(self, rows):
+    self.postings = {}
+    # question id -> {term: frequency}, what remove() has to take out
+    self.documents_terms = {}
+    for question_id, text in rows:
+      frequencies = term_frequencies(text)
+      self.documents_terms[question_id] = frequencies
+      for term, frequency in frequencies.items():
+        self.postings.setdefault(term, {})[question_id] = frequency
+    self.terms = sorted(self.postings)
+    self.documents = len(self.documents_terms)
+
+  def add(self, question_id, text):
+    self.remove(question_id)
+    frequencies = term_frequencies(text)
+    new_terms = []
+    for term, frequency in frequencies.items():
+      term_postings = self.postings.get(term)
+      if term_postings is None:
+        new_terms.append(term)
+        term_postings = {}
+      self.postings[term] = {**term_postings, question_id: frequency}
+    if new_terms:
+      self.terms = sorted(self.terms + new_terms)
+    self.documents_terms[question_id] = frequencies
+    self.documents = len(self.documents_terms)
+
+  def remove(self, question_id):
+    frequencies = self.documents_terms.pop(question_id, None)
+    if frequencies is None:
+      return
+    gone = set()
+    for term in frequencies:
+      term_postings = {other: frequency for other, frequency in self.postings[term].items() if other != question_id}
+      if term_postings:
+        self.postings[term] = term_postings
+      else:
+        gone.add(term)
+    if gone:
+      self.terms = [term for term in self.terms if term not in gone]
+      for term in gone:
+        del self.postings[term]
+    self.documents = len(self.documents_terms)
+
+  def _word_scores(self, word):
+    scores = {}
+    terms = self.terms
+    position = bisect.bisect_left(terms, word)
+    while position < len(terms) and terms[position].startswith(word):
+      # a term removed since `terms` was read has no postings left
+      term_postings = self.postings.get(terms[position])
+      position += 1
+      if not term_postings:
+        continue
+      idf = math.log(1 + self.documents / len(term_postings))
+      for question_id, frequency in term_postings.items():
+        scores[question_id] = scores.get(question_id, 0) + frequency * idf
+    return scores
+
+  def search(self, term):
+    scores = None
+    for word in tokenize(term):
+      word_scores = self._word_scores(word)
+      if scores is None:
+        scores = word_scores
+      else:
+        scores = {question_id: score + word_scores[question_id]
+                  for question_id, score in scores.items() if question_id in word_scores}
+      if not scores:
+        return []
+
+    if scores is None:
+      return []
+    return [question_id for question_id, score in
+            sorted(scores.items(), key=lambda item: (-item[1], item[0]))]
+
+
+'''
+QuestionSearch
+    ranked, paginated question search. search() returns one page of
+    Question.projection() rows and the total number of matches. A term
+    without any word matches every question, by id.
+'''
+class QuestionSearch:
+  def __init__(self, per_page):
+    self.per_page = per_page
+    self.index_cache = VersionedCache('questions', self._build_index,
+      lambda: cache_version('questions'), updater=self._apply_change)
+
+  def _build_index(self):
+    return InvertedIndex(db.session.query(Question.id, Question.question).yield_per(1000))
+
+  '''
+  _apply_change(index, change)
+      patches the index with a models.QuestionChange: removed questions
+      are dropped and added ones (re)indexed with their current text
+  '''
+  def _apply_change(self, index, change):
+    for question_id, _ in change.removed:
+      index.remove(question_id)
+    added_ids = [question_id for question_id, _ in change.added]
+    if not added_ids:
+      return
+    with on_primary():
+      rows = db.session.query(Question.id, Question.question).filter(Question.id.in_(added_ids)).all()
+    for question_id, text in rows:
+      index.add(question_id, text)
+
+  def search(self, term, page=1):
+    offset = (page - 1) * self.per_page
+    if not tokenize(term):
+      return self._all_questions(offset)
+    if db.engine.dialect.name == 'postgresql':
+      return self._search_postgres(term, offset)
+    return self._search_index(term, offset)
+
+  def _all_questions(self, offset):
+    questions = Question.projection().order_by(Question.id).offset(offset).limit(self.per_page).all()
+    return questions, question_count()
+
+  def _search_postgres(self, term, offset):
+    tsquery_text = prefix_tsquery(term)
+    if not tsquery_text:
+      return [], 0
+
+    tsquery = func.to_tsquery(
+      literal_column("'{}'::regconfig".format(SEARCH_CONFIG)), tsquery_text)
+    matches = Question.projection().filter(search_vector.op('@@')(tsquery))
+    total = matches.count()
+    questions = matches.order_by(func.ts_rank(search_vector, tsquery).desc(), Question.id) \
+      .offset(offset).limit(self.per_page).all()
+
+    return questions, total
+
+  def _search_index(self, term, offset):
+    ranked_ids = self.index_cache.get().search(term)
+    page_ids = ranked_ids[offset:offset + self.per_page]
+    if not page_ids:
+      return [], len(ranked_ids)
+
+    by_id = {row.id: row for row in Question.projection().filter(Question.id.in_(page_ids))}
+    questions = [by_id[question_id] for question_id in page_ids if question_id in by_id]
+
+    return questions, len(ranked_ids)
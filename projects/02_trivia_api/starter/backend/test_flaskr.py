@@ -1,10 +1,195 @@
+import asyncio
+import gzip
 import os
+import re
+import subprocess
+import sys
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from types import SimpleNamespace
+from unittest import mock
+from flask import Flask
+from sqlalchemy import create_engine, event, text
 
+import cache
 from flaskr import create_app
-from models import setup_db, Question, Category
+from instrumentation import SlowQueryLog, NPlusOneError, detect_n_plus_one, instrument
+from routing import ReplicaRouter, PRIMARY_COOKIE, PRIMARY_HEADER
+from models import db, Question, Category, adjust_category_counts, backfill_category_counts, bump_cache_version, cache_version, category_counts, reset_question_count
+from search import InvertedIndex, QuestionSearch
+from quiz import ALL_CATEGORIES, DatabaseSessionStore, MemorySessionStore, QuizSampler, QuizSession, SeenSet
+
+# TRIVIA_ASYNC=1 runs every test against the asyncio app instead,
+# the sync app stays around for the direct model queries
+ASYNC = bool(os.environ.get('TRIVIA_ASYNC'))
+
+app = None
+async_client = None
+
+
+def database_url_for_tests():
+    """TRIVIA_TEST_DATABASE_URL, in-memory SQLite by default. The asyncio app
+    opens its own connections, so it gets a database file instead. Every
+    pytest-xdist worker gets a database of its own."""
+    url = os.environ.get('TRIVIA_TEST_DATABASE_URL')
+    if url is None:
+        if not ASYNC:
+            return 'sqlite://'
+        url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'trivia_test.db')
+
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker and url != 'sqlite://':
+        root, extension = os.path.splitext(url)
+        url = '{}_{}{}'.format(root, worker, extension)
+        if url.startswith('postgres'):
+            create_database(url)
+    return url
+
+
+def create_database(url):
+    server, name = url.rsplit('/', 1)
+    engine = create_engine(server + '/postgres', isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        exists = connection.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'), {'name': name}).scalar()
+        if not exists:
+            connection.execute(text('CREATE DATABASE "{}"'.format(name)))
+    engine.dispose()
+
+
+def load_fixtures():
+    """Loads the categories and questions of trivia.psql into a database
+    that doesn't have them yet (in-memory SQLite, a fresh worker database)."""
+    if Category.query.first() is not None:
+        return
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trivia.psql')) as f:
+        dump = f.read()
+    for table in (Category.__table__, Question.__table__):
+        match = re.search(r'^COPY public\.{} \((.*?)\) FROM stdin;\n(.*?)^\\\.$'.format(table.name), dump, re.M | re.S)
+        columns = [column.strip() for column in match.group(1).split(',')]
+        rows = [dict(zip(columns, line.split('\t'))) for line in match.group(2).splitlines()]
+        db.session.execute(table.insert(), rows)
+    if db.engine.dialect.name == 'postgresql':
+        for table in ('categories', 'questions'):
+            db.session.execute(text("SELECT setval('{0}_id_seq', (SELECT max(id) FROM {0}))".format(table)))
+    db.session.commit()
+    backfill_category_counts()
+
+
+def enable_sqlite_savepoints(engine):
+    """pysqlite only opens transactions right before a write, which breaks
+    SAVEPOINT. Let SQLAlchemy emit BEGIN itself instead."""
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute(text('BEGIN'))
+
+
+def setUpModule():
+    """The app, schema and fixtures are built once per test run."""
+    global app, async_client
+    database_url = database_url_for_tests()
+    app = create_app({'DATABASE_URL': database_url, 'TESTING': True, 'DEBUG_ENDPOINTS': True})
+    # a request running the same statement over and over fails its test
+    detect_n_plus_one(app, strict=True)
+    load_fixtures()
+
+    if ASYNC:
+        # the asyncio app commits for real, its tests share the database
+        from flaskr.aio import create_async_app
+        async_client = AsyncTestClient(create_async_app({'DATABASE_URL': database_url, 'DEBUG_ENDPOINTS': True}))
+    elif db.engine.dialect.name == 'sqlite':
+        enable_sqlite_savepoints(db.engine)
+
+
+def tearDownModule():
+    if async_client is not None:
+        async_client.close()
+
+
+class SavepointSession:
+    """Runs one test inside a transaction that is rolled back at the end.
+
+    db.session is swapped for a session bound to that transaction, which
+    does its work in a SAVEPOINT: a commit by the app releases the SAVEPOINT
+    and a new one is started right away, a rollback only undoes the work
+    since the last commit."""
+
+    def __init__(self):
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.original_session = db.session
+
+        self.session = db.create_scoped_session({'bind': self.connection, 'binds': {}})
+        # the app removes its session after every request, the test keeps
+        # the one holding the SAVEPOINT
+        self.session.remove = self.session.expire_all
+        event.listen(self.session, 'after_transaction_end', self.restart_savepoint)
+        self.session.begin_nested()
+        db.session = self.session
+
+    @staticmethod
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+    def rollback(self):
+        event.remove(self.session, 'after_transaction_end', self.restart_savepoint)
+        # closing alone would leave the SAVEPOINT open on the connection
+        self.session.rollback()
+        self.session.close()
+        self.transaction.rollback()
+        self.connection.close()
+        db.session = self.original_session
+
+        # the caches saw the rolled back data
+        reset_question_count()
+        cache.invalidate_all()
+
+
+class AsyncTestClient:
+    """Drives the asyncio app (flaskr/aio.py) through the interface of
+    Flask's test client, so the same tests run against both apps."""
+    loop = None
+
+    def __init__(self, app):
+        if AsyncTestClient.loop is None:
+            AsyncTestClient.loop = asyncio.new_event_loop()
+        self.app = app
+        self.loop.run_until_complete(app.startup())
+
+    def __call__(self):
+        return self
+
+    def close(self):
+        self.loop.run_until_complete(self.app.shutdown())
+
+    def open(self, path, method, content_type=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if isinstance(kwargs.get('data'), str):
+            kwargs['data'] = kwargs['data'].encode()
+
+        async def request():
+            response = await self.app.test_client().open(path, method=method, headers=headers, **kwargs)
+            return SimpleNamespace(status_code=response.status_code, headers=response.headers,
+                                   data=await response.get_data())
+        return self.loop.run_until_complete(request())
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, 'DELETE', **kwargs)
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,22 +197,19 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = app
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}:{}@{}/{}".format('postgres', 'root', 'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        self.savepoint = None
+
+        if ASYNC:
+            self.client = async_client
+        else:
+            self.savepoint = SavepointSession()
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        if self.savepoint is not None:
+            self.savepoint.rollback()
 
     """
     TODO
@@ -51,6 +233,127 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertGreater(len(data['categories']), 0)
 
+    def test_get_categories_after_creating_category(self):
+        self.client().get('/categories')
+        self.client().post('/category', json={"cat_type": 'cached_cat'})
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('cached_cat', data['categories'].values())
+
+    def test_get_categories_with_counts(self):
+        res = self.client().get('/categories?with_counts=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['counts']), set(data['categories']))
+        self.assertEqual(data['counts']['1'], Question.query.filter(Question.category == 1).count())
+
+        self.client().post('/questions', json={"question": "counted question", "answer": "answer", "difficulty": "1", "category": "1"})
+        res = self.client().get('/categories?with_counts=1')
+        self.assertEqual(json.loads(res.data)['counts']['1'], data['counts']['1'] + 1)
+
+    def test_get_pool_status(self):
+        res = self.client().get('/debug/pool')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['pool'])
+
+    @unittest.skipIf(ASYNC, 'the asyncio app is not instrumented')
+    def test_server_timing_header(self):
+        res = self.client().get('/questions?page=1')
+        timing = res.headers['Server-Timing']
+
+        self.assertIn('app;dur=', timing)
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="statements=[1-9][0-9]*"')
+
+    @unittest.skipIf(ASYNC, 'the asyncio app is not instrumented')
+    def test_get_metrics(self):
+        self.client().get('/categories')
+        res = self.client().get('/metrics')
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/categories",status="200"}', body)
+        self.assertIn('http_request_sql_statements_bucket{method="GET",route="/categories",status="200",le="+Inf"}', body)
+
+    @unittest.skipIf(ASYNC, 'the asyncio app is not instrumented')
+    def test_slow_query_log(self):
+        slow_queries = SlowQueryLog(threshold=0).start()
+        self.addCleanup(slow_queries.stop)
+        self.client().get('/categories/1/questions')
+
+        records = [r for r in slow_queries.records()
+                   if r['route'] == 'GET /categories/<int:cat_id>/questions' and r['statement'].startswith('SELECT')]
+        self.assertTrue(records)
+        self.assertTrue(all(r['plan'] for r in records))
+
+        path = os.path.join(tempfile.mkdtemp(), 'slow_queries.ndjson')
+        slow_queries.dump(path)
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), len(slow_queries.records()))
+
+    def test_vendored_modules_match(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'shared_modules.py')
+        if not os.path.exists(script):
+            self.skipTest('the other projects are not checked out')
+        check = subprocess.run([sys.executable, script], stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(check.returncode, 0, check.stdout)
+
+    def test_debug_endpoints_are_opt_in(self):
+        with mock.patch.dict(os.environ, {'SLOW_QUERY_MS': '', 'DEBUG_ENDPOINTS': ''}):
+            self.assertIsNone(SlowQueryLog.from_env())
+            bare_app = Flask('bare')
+            instrument(bare_app)
+        self.assertNotIn('/debug/slow-queries', [rule.rule for rule in bare_app.url_map.iter_rules()])
+
+    @unittest.skipIf(ASYNC, 'the asyncio app is not instrumented')
+    def test_n_plus_one_detector(self):
+        detector = self.app.extensions['n_plus_one']
+        with self.app.test_request_context('/questions'):
+            self.app.preprocess_request()
+            for question_id in range(1, detector.threshold + 2):
+                Question.query.get(question_id)
+            with self.assertRaises(NPlusOneError):
+                self.app.process_response(self.app.response_class())
+
+    @unittest.skipIf(ASYNC, 'the asyncio app reads from the primary only')
+    def test_get_requests_read_from_replica(self):
+        router = ReplicaRouter(['sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')], sticky_seconds=60)
+        replica = router.engines[0]
+        db.Model.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Category.__table__.insert(), {'id': 1, 'type': 'replica category'})
+            connection.execute(Question.__table__.insert(), {'id': 1, 'question': 'replica question',
+                'answer': 'replica answer', 'category': 1, 'difficulty': 1})
+        self.app.extensions['replica_router'] = router
+        self.addCleanup(self.app.extensions.pop, 'replica_router')
+        cache.invalidate_all()
+
+        res = self.client().get('/questions')
+        data = json.loads(res.data)
+        self.assertEqual([question['question'] for question in data['questions']], ['replica question'])
+        # the shared caches are filled from the primary
+        self.assertNotIn('replica category', data['categories'].values())
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+        # after a write this worker reads from the primary, whoever asks
+        res = self.client().post('/category', json={"cat_type": 'primary category'})
+        self.assertTrue(res.headers['Set-Cookie'].startswith(PRIMARY_COOKIE + '='))
+        self.assertIn(PRIMARY_HEADER, res.headers['Access-Control-Expose-Headers'])
+        primary_until = res.headers[PRIMARY_HEADER]
+        res = self.client().get('/questions')
+        self.assertNotIn('replica question', [question['question'] for question in json.loads(res.data)['questions']])
+
+        # and so does, on any worker, a client echoing the header
+        router.primary_until = 0
+        res = self.client().get('/questions', headers={PRIMARY_HEADER: primary_until})
+        self.assertNotIn('replica question', [question['question'] for question in json.loads(res.data)['questions']])
+        res = self.client().get('/questions')
+        self.assertIn('replica question', [question['question'] for question in json.loads(res.data)['questions']])
+
     def test_get_questions_with_valid_page_number(self):
         res = self.client().get('/questions?page=1')
         data = json.loads(res.data)
@@ -76,6 +379,80 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'resource was not found')
         self.assertFalse(data['success'])
 
+    def test_get_questions_not_modified(self):
+        res = self.client().get('/questions?page=1')
+        etag = res.headers['ETag']
+
+        res = self.client().get('/questions?page=1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+        self.client().post('/questions', json={"question": "etag question", "answer": "etag answer", "difficulty": "1", "category": "5"})
+        res = self.client().get('/questions?page=1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_etag_follows_writes_of_other_workers(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+
+        # another worker's write: the version is bumped but nothing in
+        # this process invalidated its caches
+        db.session.execute(Category.__table__.insert(), {'type': 'other worker category'})
+        db.session.execute(Question.__table__.insert(), {'question': 'other worker question',
+            'answer': 'answer', 'category': 1, 'difficulty': 1})
+        adjust_category_counts({1: 1})
+        bump_cache_version('categories')
+        bump_cache_version('questions')
+        db.session.commit()
+
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('other worker category', json.loads(res.data)['categories'].values())
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], Question.query.count())
+
+    def test_bump_cache_version_creates_the_row(self):
+        name = 'test_bump_{}'.format(os.getpid())
+        self.assertEqual(bump_cache_version(name), 1)
+        self.assertEqual(bump_cache_version(name), 2)
+        db.session.commit()
+        self.assertEqual(cache_version(name), 2)
+
+    def test_adjust_category_counts_creates_the_counter(self):
+        category = Category(type='uncounted')
+        category.insert()
+        adjust_category_counts({category.id: 1})
+        adjust_category_counts({category.id: 2})
+        db.session.commit()
+        self.assertEqual(category_counts()[category.id], 3)
+
+        adjust_category_counts({category.id: -3})
+        db.session.commit()
+        self.assertEqual(category_counts()[category.id], 0)
+
+    def test_get_questions_with_cursor(self):
+        res = self.client().get('/questions?page=1')
+        first_page = json.loads(res.data)
+        self.assertTrue(first_page["next_cursor"])
+
+        res = self.client().get('/questions?after={}'.format(first_page["next_cursor"]))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(len(data["questions"]), 0)
+        last_id = first_page["questions"][-1]["id"]
+        self.assertTrue(all(q["id"] > last_id for q in data["questions"]))
+        self.assertEqual(data["total_questions"], first_page["total_questions"])
+
+    def test_get_questions_with_invalid_cursor(self):
+        res = self.client().get('/questions?after=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['error'], 422)
+        self.assertFalse(data['success'])
+
     # def test_delete_question_with_valid_id(self):
     #     res = self.client().delete('/questions/2')
     #     data = json.loads(res.data)
@@ -86,6 +463,24 @@ class TriviaTestCase(unittest.TestCase):
     #     self.assertTrue(data['deleted'])
     #     self.assertIsNone(deleted_question)
     
+    def test_export_questions_as_ndjson(self):
+        res = self.client().get('/questions/export')
+        exported = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(exported), Question.query.count())
+        self.assertEqual([q['id'] for q in exported], sorted(q['id'] for q in exported))
+        self.assertEqual(set(exported[0]), {'id', 'question', 'answer', 'category', 'difficulty'})
+
+    def test_export_questions_gzip(self):
+        res = self.client().get('/questions/export', headers={'Accept-Encoding': 'gzip'})
+        lines = gzip.decompress(res.data).decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(lines), Question.query.count())
+
     def test_delete_question_with_invalid_id(self):
         res = self.client().delete('/questions/53435735435')
         data = json.loads(res.data)
@@ -95,6 +490,49 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Unprocessable Entity')
         self.assertFalse(data['success'])
     
+    def test_bulk_delete_by_ids(self):
+        questions = [{"question": "to delete", "answer": "a", "difficulty": 5, "category": 3} for i in range(2)]
+        self.client().post('/questions/bulk', json=questions)
+        ids = [q.id for q in Question.query.filter(Question.question == "to delete").all()]
+
+        res = self.client().delete('/questions', json={"ids": ids})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['deleted_count'], len(ids))
+        self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 0)
+
+    def test_bulk_delete_by_filter(self):
+        questions = [{"question": "to delete by filter", "answer": "a", "difficulty": 5, "category": 6} for i in range(2)]
+        self.client().post('/questions/bulk', json=questions)
+
+        res = self.client().delete('/questions', json={"category": 6, "difficulty": 5})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreaterEqual(data['deleted_count'], 2)
+        self.assertEqual(Question.query.filter(Question.question == "to delete by filter").count(), 0)
+
+    def test_bulk_delete_rejects_malformed_criteria(self):
+        total = Question.query.count()
+
+        for body in ({"ids": "1216"}, {"ids": [2, True]}, {"ids": 2}, {"category": True}, {"difficulty": "5"}):
+            res = self.client().delete('/questions', json=body)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422, body)
+            self.assertFalse(data['success'])
+        self.assertEqual(Question.query.count(), total)
+
+    def test_bulk_delete_without_criteria(self):
+        res = self.client().delete('/questions', json={})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['error'], 422)
+        self.assertFalse(data['success'])
+
     def test_create_new_question(self):
         res = self.client().post('/questions', json={"question": "new question", "answer": "new answer", "difficulty": "1", "category": "5"})
         data = json.loads(res.data)
@@ -150,6 +588,58 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Unprocessable Entity')
         self.assertFalse(data['success'])
 
+    def test_bulk_import_json_array(self):
+        questions = [
+            {"question": "bulk question {}".format(i), "answer": "bulk answer", "difficulty": 1, "category": 1}
+            for i in range(3)
+        ]
+        questions.append({"question": "bulk question", "answer": "bulk answer", "difficulty": 1, "category": 1000})
+        questions.append({"answer": "bulk answer", "difficulty": 1, "category": 1})
+        res = self.client().post('/questions/bulk', json=questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['inserted'], 3)
+        self.assertEqual([error['row'] for error in data['errors']], [4, 5])
+
+    def test_bulk_import_rejects_non_integer_and_out_of_range_values(self):
+        questions = [
+            {"question": "float category", "answer": "a", "difficulty": 1, "category": 1.9},
+            {"question": "bool difficulty", "answer": "a", "difficulty": True, "category": 1},
+            {"question": "string difficulty", "answer": "a", "difficulty": "2", "category": 1},
+            {"question": "too difficult", "answer": "a", "difficulty": 99, "category": 1},
+            {"question": "just right", "answer": "a", "difficulty": 5, "category": 1},
+        ]
+        res = self.client().post('/questions/bulk', json=questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([error['row'] for error in data['errors']], [1, 2, 3, 4])
+        self.assertEqual(data['errors'][3]['error'], 'difficulty must be from 1 to 5')
+
+    def test_bulk_import_ndjson(self):
+        lines = [
+            json.dumps({"question": "ndjson question", "answer": "ndjson answer", "difficulty": 2, "category": 2}),
+            "{not json",
+            json.dumps({"question": "ndjson question 2", "answer": "ndjson answer", "difficulty": 2, "category": 2}),
+        ]
+        res = self.client().post('/questions/bulk', data="\n".join(lines), content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['errors'], [{"row": 2, "error": "row is not a JSON object"}])
+
+    def test_bulk_import_without_array(self):
+        res = self.client().post('/questions/bulk', json={"question": "not a list"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['error'], 422)
+        self.assertFalse(data['success'])
+
     def test_search_for_term(self):
         res = self.client().post('/questions', json={"searchTerm": "M"})
         data = json.loads(res.data)
@@ -168,6 +658,64 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['questions']), 0)
         self.assertEqual(data['totalQuestions'], 0)
 
+    def test_search_matches_every_word_as_prefix(self):
+        res = self.client().post('/questions', json={"searchTerm": "tom han"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(data['totalQuestions'], 0)
+        for question in data['questions']:
+            self.assertIn('tom', question['question'].lower())
+            self.assertIn('han', question['question'].lower())
+
+    def test_search_with_empty_term_lists_every_question(self):
+        res = self.client().post('/questions', json={"searchTerm": ""})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['totalQuestions'], Question.query.count())
+        ids = [question['id'] for question in data['questions']]
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_search_index_follows_writes_in_place(self):
+        index = InvertedIndex([(1, 'Whose autobiography is entitled'), (2, 'What boxer autobiography')])
+        index.add(3, 'Which autobiography quokka')
+        index.remove(1)
+        index.add(2, 'What boxer')
+        rebuilt = InvertedIndex([(2, 'What boxer'), (3, 'Which autobiography quokka')])
+
+        self.assertEqual(index.postings, rebuilt.postings)
+        self.assertEqual(index.terms, rebuilt.terms)
+        self.assertEqual(index.search('autob'), [3])
+
+    @unittest.skipIf(os.environ.get('TRIVIA_TEST_DATABASE_URL', '').startswith('postgres'),
+                     'Postgres searches without the in-process index')
+    def test_question_writes_patch_the_search_index(self):
+        question_search = QuestionSearch(10)
+        self.assertEqual(question_search.search('zyzzyva'), ([], 0))
+        index = question_search.index_cache.get()
+
+        question = Question(question='zyzzyva weevil', answer='a', category=1, difficulty=1)
+        question.insert()
+        self.assertEqual([row.id for row in question_search.search('zyzzyva')[0]], [question.id])
+        question.question = 'quokka weevil'
+        question.update()
+        self.assertEqual(question_search.search('zyzzyva'), ([], 0))
+        self.assertEqual([row.id for row in question_search.search('quokka')[0]], [question.id])
+        question.delete()
+        self.assertEqual(question_search.search('weevil'), ([], 0))
+        # patched, never rebuilt
+        self.assertIs(question_search.index_cache.get(), index)
+
+    def test_search_for_term_with_invalid_page(self):
+        res = self.client().post('/questions', json={"searchTerm": "M", "page": 0})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['error'], 422)
+        self.assertFalse(data['success'])
+
     def test_get_questions_by_category(self):
         res = self.client().get('/categories/1/questions')
         data = json.loads(res.data)
@@ -181,6 +729,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertGreater(len(data["questions"]), 0)
         self.assertGreater(data["total_questions"], 0)
 
+    def test_get_questions_by_category_matches_orm_format(self):
+        res = self.client().get('/categories/1/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            expected = [q.format() for q in Question.query.filter(Question.category == 1).order_by(Question.id)]
+        self.assertEqual(data["questions"], expected)
+
     def test_get_questions_by_category_not_found(self):
         res = self.client().get('/categories/1000/questions')
         data = json.loads(res.data)
@@ -216,6 +773,121 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question'])
         self.assertIsNotNone(data['question'])
     
+    def test_generate_quiz_question_skips_previous_questions(self):
+        category_ids = [q['id'] for q in json.loads(self.client().get('/categories/1/questions').data)['questions']]
+        res = self.client().post('/quizzes', json={"previous_questions": category_ids[1:], "quiz_category": {"type": "Science", "id": 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], category_ids[0])
+
+    def test_generate_quiz_question_when_category_exhausted(self):
+        category_ids = [q['id'] for q in json.loads(self.client().get('/categories/1/questions').data)['questions']]
+        res = self.client().post('/quizzes', json={"previous_questions": category_ids, "quiz_category": {"type": "Science", "id": 1}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['question'])
+
+    def test_quiz_session_never_repeats_questions(self):
+        res = self.client().post('/quizzes/sessions', json={"quiz_category": {"type": "Science", "id": 1}})
+        session_id = json.loads(res.data)['session_id']
+
+        played = []
+        while True:
+            res = self.client().post('/quizzes', json={"session_id": session_id})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            if data['question'] is None:
+                break
+            played.append(data['question']['id'])
+
+        self.assertGreater(len(played), 0)
+        self.assertEqual(len(played), len(set(played)))
+
+    def test_quiz_sampler_applies_local_writes(self):
+        sampler = QuizSampler()
+        sampler.ids_cache.check_interval = 0
+        loads = []
+        load_ids = sampler.ids_cache.loader
+        sampler.ids_cache.loader = lambda: loads.append(1) or load_ids()
+        sampler.ids_cache.get()
+
+        question = Question('sampled question', 'answer', 1, 1)
+        question.insert()
+        question_id = question.id
+        self.assertIn(question_id, sampler.ids_cache.get()[1])
+        question.category = 2
+        question.update()
+        self.assertNotIn(question_id, sampler.ids_cache.get()[1])
+        self.assertIn(question_id, sampler.ids_cache.get()[2])
+        question.delete()
+        self.assertNotIn(question_id, sampler.ids_cache.get()[2])
+        self.assertNotIn(question_id, sampler.ids_cache.get()[ALL_CATEGORIES])
+        self.assertEqual(len(loads), 1)
+
+        # a version this process didn't write means another worker did
+        bump_cache_version('questions')
+        db.session.commit()
+        sampler.ids_cache.get()
+        self.assertEqual(len(loads), 2)
+
+    def test_seen_set(self):
+        seen = SeenSet()
+        ids = [7, 3, 70000, 3] + list(range(100000, 100000 + SeenSet.ARRAY_LIMIT))
+        for question_id in ids:
+            seen.add(question_id)
+
+        self.assertEqual(len(seen), len(set(ids)))
+        self.assertEqual(list(seen.chunks[0]), [3, 7])
+        self.assertIsInstance(seen.chunks[100000 >> SeenSet.CHUNK_BITS], bytearray)
+        restored = SeenSet.from_bytes(seen.to_bytes())
+        self.assertEqual(len(restored), len(seen))
+        self.assertTrue(all(question_id in restored for question_id in ids))
+        self.assertNotIn(5, restored)
+        self.assertNotIn(70001, restored)
+
+    def test_memory_session_store_drops_least_recently_played(self):
+        store = MemorySessionStore(ttl=60, max_sessions=2)
+        first, second, third = QuizSession(1), QuizSession(1), QuizSession(1)
+        store.save(first)
+        store.save(second)
+        store.save(first)
+        store.save(third)
+
+        self.assertIs(store.get(first.id), first)
+        self.assertIsNone(store.get(second.id))
+        self.assertIs(store.get(third.id), third)
+
+    def test_database_session_store_is_shared_by_workers(self):
+        # one store per worker process, the sessions are in the database
+        first_worker, second_worker = DatabaseSessionStore(ttl=60), DatabaseSessionStore(ttl=60)
+        session = QuizSession(1)
+        session.seen.add(7)
+        first_worker.save(session)
+
+        restored = second_worker.get(session.id)
+        self.assertEqual(restored.category_id, 1)
+        self.assertIn(7, restored.seen)
+        self.assertTrue(second_worker.delete(session.id))
+        self.assertIsNone(first_worker.get(session.id))
+        self.assertFalse(first_worker.delete(session.id))
+
+    def test_database_session_store_expires_sessions(self):
+        store = DatabaseSessionStore(ttl=-1)
+        session = QuizSession(1)
+        store.save(session)
+
+        self.assertIsNone(store.get(session.id))
+
+    def test_quiz_session_not_found(self):
+        res = self.client().post('/quizzes', json={"session_id": "no-such-session"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['error'], 404)
+        self.assertFalse(data['success'])
+
     def test_generate_quiz_question_with_wrong_data(self):
         res = self.client().post('/category', json={})
         data = json.loads(res.data)
@@ -0,0 +1,142 @@
+'''
+Micro-benchmark of token verification.
+
+Signs tokens with a throwaway RSA key and verifies them in one thread,
+the way verify_decode_jwt does, two ways: handing jwt.decode the JWK
+(n and e are decoded and a public key is built for every token, as
+before the key store parsed its keys) and handing it the key store's
+pre-built verification key. Prints tokens verified per second per core
+for each as JSON:
+
+    python bench/verify_tokens.py --tokens 200 --duration 5 --output verify.json
+
+The token cache is not involved, every verification checks a signature.
+'''
+import argparse
+import base64
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import jose
+from jose import jwt
+
+from env import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN
+from auth.keystore import verification_key, decode_key
+
+ISSUER = f'https://{AUTH0_DOMAIN}/'
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+'''
+generate_key(bits)
+    a private key in PEM and its public JWK, with whichever RSA library
+    is installed (pycryptodome comes with the pinned python-jose-cryptodome)
+'''
+def generate_key(bits=2048, kid='bench'):
+    try:
+        from Crypto.PublicKey import RSA
+        private = RSA.generate(bits)
+        pem = private.export_key('PEM').decode()
+        n, e = private.n, private.e
+    except ImportError:
+        import rsa
+        public, private = rsa.newkeys(bits)
+        pem = private.save_pkcs1().decode()
+        n, e = public.n, public.e
+    return pem, {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256', 'n': b64_int(n), 'e': b64_int(e)}
+
+
+def sign_tokens(pem, kid, count):
+    now = int(time.time())
+    return [jwt.encode({
+        'iss': ISSUER,
+        'aud': API_AUDIENCE,
+        'sub': f'bench|{i}',
+        'iat': now,
+        'exp': now + 3600,
+        'permissions': ['get:drinks-detail'],
+    }, pem, algorithm='RS256', headers={'kid': kid}) for i in range(count)]
+
+
+def decode_with_jwk(token, key):
+    rsa_key = {
+        'kty': key['kty'],
+        'kid': key['kid'],
+        'use': key['use'],
+        'n': key['n'],
+        'e': key['e'],
+    }
+    return jwt.decode(token, rsa_key, algorithms=ALGORITHMS, audience=API_AUDIENCE, issuer=ISSUER)
+
+def decode_with_prepared(token, key):
+    return jwt.decode(token, decode_key(key), algorithms=ALGORITHMS, audience=API_AUDIENCE, issuer=ISSUER)
+
+'''
+throughput(decode, tokens, key, duration)
+    verifies the tokens round robin for `duration` seconds, returns the
+    tokens verified and the rate per second
+'''
+def throughput(decode, tokens, key, duration):
+    verified = 0
+    tokens = itertools.cycle(tokens)
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        decode(next(tokens), key)
+        verified += 1
+    elapsed = time.perf_counter() - started
+    return verified, round(verified / elapsed, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure RS256 tokens verified per second.')
+    parser.add_argument('--tokens', type=int, default=100, help='distinct tokens to verify')
+    parser.add_argument('--bits', type=int, default=2048, help='RSA key size')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per variant')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    pem, jwk = generate_key(args.bits)
+    tokens = sign_tokens(pem, jwk['kid'], args.tokens)
+    prepared = verification_key(jwk)
+    if decode_with_jwk(tokens[0], jwk) != decode_with_prepared(tokens[0], prepared):
+        raise SystemExit('the two variants decoded different payloads')
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'jose': jose.__version__,
+            'bits': args.bits,
+            'tokens': args.tokens,
+            'duration_s': args.duration,
+        },
+        'variants': {},
+    }
+    for name, decode, key in (('jwk', decode_with_jwk, jwk), ('prepared_key', decode_with_prepared, prepared)):
+        print(f'measuring {name}', file=sys.stderr)
+        verified, rate = throughput(decode, tokens, key, args.duration)
+        report['variants'][name] = {'verified': verified, 'tokens_per_second': rate}
+
+    report['speedup'] = round(report['variants']['prepared_key']['tokens_per_second'] /
+                              report['variants']['jwk']['tokens_per_second'], 2)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,69 +5,45 @@ from sqlalchemy import exc
 import json
 from flask_cors import CORS
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
+from .database.models import db_drop_and_create_all, db_pool_status, setup_db, Drink
 from .auth.auth import AuthError, requires_auth
+from .auth.management import ManagementClient, ManagementAPIError
+from .auth.directory import UserDirectory
+from .instrumentation import instrument, detect_n_plus_one, debug_endpoints_enabled
 
-import http.client
 from env import *
 
 app = Flask(__name__)
 setup_db(app)
-cors = CORS(app, resources={r"/*": {"origins": "*"}})
+# Server-Timing on every response, histograms on /metrics
+instrument(app)
+if app.debug:
+    detect_n_plus_one(app)
+# the /users paging headers have to be readable by the frontend
+cors = CORS(app, resources={r"/*": {"origins": "*"}},
+            expose_headers=['X-Total-Count', 'X-Page', 'X-Per-Page', 'X-Users-Truncated'])
 
 
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-DB-Primary-Until,true')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
 
     return response
 
 
-def get_management_api_access_token():
-    conn = http.client.HTTPSConnection(AUTH0_DOMAIN)
-
-    management_payload = f"grant_type=client_credentials&client_id={M_TO_M_CLIENT_ID}&client_secret={M_TO_M_CLIENT_SECRET}&audience=https://{AUTH0_DOMAIN}/api/v2/"
-
-    headers = { 
-        'content-type': "application/x-www-form-urlencoded"
-    }
-
-    conn.request("POST", "/oauth/token", management_payload, headers)
-    
-    res = conn.getresponse()
-    data = res.read()
-    decoded_data = data.decode("utf-8")
-    jsonDic = json.loads(decoded_data)
-    access_token = ''
-    if 'access_token' in jsonDic:
-        access_token = jsonDic['access_token']
-
-    return access_token
-
-def get_users_data():
-    access_token = get_management_api_access_token()
-
-    if not access_token:
-        abort(401)
-    
-    conn = http.client.HTTPSConnection(AUTH0_DOMAIN)
-
-    headers = { 
-        'Authorization': f"Bearer {access_token}"
-    }
-
-    conn.request("GET", "/api/v2/users", headers=headers)
-    
-    res = conn.getresponse()
-    data = res.read()
-    decoded_data = data.decode("utf-8")
-    jsonDic = json.loads(decoded_data)
+'''
+the Auth0 management API, with its token and connections reused across
+requests, see auth.management.ManagementClient
+'''
+management = ManagementClient.from_env()
 
-    if not jsonDic:
-        abort(401)
-    
-    return jsonDic
+'''
+a local copy of the tenant's users that /users pages and searches,
+see auth.directory.UserDirectory
+'''
+user_directory = UserDirectory.from_env(management)
+USERS_PER_PAGE = 50
 
 '''
 @TODO uncomment the following line to initialize the datbase
@@ -212,29 +188,58 @@ def delete_drink(payload, id):
     }), 200
 
 ## Users management 
+'''
+GET /users
+    requires the 'read:users' permission
+    one page of the tenant's users, sorted by email, as a list of
+    {"email", "nickname", "user_id"}. Query arguments: page (from 1),
+    per_page (default 50, at most 100) and q, a prefix of the email or
+    nickname. The X-Total-Count header has the number of matches, and
+    X-Page / X-Per-Page echo the page served. Only the first 1000 users
+    of the tenant can be listed, X-Users-Truncated: true says there are
+    more.
+'''
 @app.route('/users')
 @requires_auth('read:users')
 def get_users(payload):
-    body = []
-    users = get_users_data()
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', USERS_PER_PAGE, type=int)
+    if page < 1 or not 1 <= per_page <= 100:
+        abort(422)
+
+    try:
+        users, total, truncated = user_directory.search(request.args.get('q', ''), page, per_page)
+    except ManagementAPIError as error:
+        # Auth0 failed, not the caller: unreachable or an error answer
+        abort(503 if error.status is None else 502)
+
+    response = jsonify([user._asdict() for user in users])
+    response.headers['X-Total-Count'] = str(total)
+    response.headers['X-Page'] = str(page)
+    response.headers['X-Per-Page'] = str(per_page)
+    if truncated:
+        response.headers['X-Users-Truncated'] = 'true'
+    return response
 
-    if not users:
-        abort(401)
 
-    for user in users:
-        body.append({
-            'email': user['email'],
-            'nickname': user['nickname'],
-            'user_id': user['user_id'],
-        })
 
-    return jsonify(body)
 
 
 
 
 
+## Introspection
+'''
+GET /debug/pool
+    connection pool statistics: connections checked out, overflow in use
+    and how long requests waited for a connection. Only served with debug
+    endpoints, see instrumentation.debug_endpoints_enabled
+'''
+def get_pool_status():
+    return jsonify(db_pool_status()), 200
 
+if debug_endpoints_enabled(app):
+    app.add_url_rule('/debug/pool', 'get_pool_status', get_pool_status)
 
 
 ## Error Handling
@@ -281,6 +286,22 @@ def unprocessable(error):
                     "message": "Unauthorized Access"
                     }), 401
 
+@app.errorhandler(502)
+def bad_gateway(error):
+    return jsonify({
+                    "success": False,
+                    "error": 502,
+                    "message": "the Auth0 management API answered with an error"
+                    }), 502
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    return jsonify({
+                    "success": False,
+                    "error": 503,
+                    "message": "the Auth0 management API could not be reached"
+                    }), 503
+
 '''
 @TODO implement error handler for AuthError
     error handler should conform to general task above 
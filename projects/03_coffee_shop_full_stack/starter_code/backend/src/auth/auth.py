@@ -1,10 +1,10 @@
-import json
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 from sqlalchemy.sql.elements import Null
 from env import *
+from .keystore import KeyStore, KeyStoreError, decode_key
+from .tokencache import TokenCache
 
 from sqlalchemy.sql.schema import RETAIN_SCHEMA
 
@@ -19,6 +19,20 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## Signing keys
+'''
+the tenant's JWKS, fetched once and refreshed in the background,
+see keystore.KeyStore
+'''
+jwks = KeyStore.from_env()
+
+'''
+payloads of the tokens verified so far, until they expire,
+see tokencache.TokenCache
+'''
+verified_tokens = TokenCache.from_env()
+
+
 ## Auth Header
 
 '''
@@ -80,8 +94,11 @@ def get_token_auth_header():
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # a token that was verified before skips the signature check
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
     
     
@@ -91,26 +108,24 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed'
         }, 401)
     
-    rsa_key = {}
-    
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e'],
-            }
-    if rsa_key:
+    try:
+        key = jwks.get(unverified_header['kid'])
+    except KeyStoreError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to load the signing keys.'
+        }, 503)
+
+    if key is not None:
         try:
             payload = jwt.decode(
                 token,
-                rsa_key,
+                decode_key(key),
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
                 issuer=f'https://{AUTH0_DOMAIN}/'
             )
+            verified_tokens.put(token, payload)
 
             return payload
 
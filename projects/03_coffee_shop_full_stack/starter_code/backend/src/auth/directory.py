@@ -0,0 +1,218 @@
+import bisect
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from .management import ManagementAPIError
+
+User = namedtuple('User', ['email', 'nickname', 'user_id'])
+
+# the management API serves at most 100 users per page, and pages through
+# the first 1000 users of a query only, later pages are an error
+MAX_PER_PAGE = 100
+LIST_LIMIT = 1000
+# seconds between reloads after one failed
+RETRY_INTERVAL = 30
+
+'''
+Snapshot(users, total)
+    the users sorted by email, with email and nickname indexes for
+    case insensitive prefix search. `total` is the number of users the
+    tenant has; truncated is set when that's more than could be listed.
+'''
+class Snapshot:
+    def __init__(self, users, total=None):
+        self.total = len(users) if total is None else total
+        self.truncated = self.total > len(users)
+        self.users = sorted(users, key=lambda user: ((user.email or '').lower(), user.user_id))
+        self.by_email = sorted(((user.email or '').lower(), position) for position, user in enumerate(self.users))
+        self.by_nickname = sorted(((user.nickname or '').lower(), position) for position, user in enumerate(self.users))
+
+    @staticmethod
+    def _prefixed(index, prefix):
+        position = bisect.bisect_left(index, (prefix,))
+        while position < len(index) and index[position][0].startswith(prefix):
+            yield index[position][1]
+            position += 1
+
+    '''
+    search(prefix)
+        the users whose email or nickname starts with `prefix`, by email
+    '''
+    def search(self, prefix):
+        prefix = (prefix or '').lower()
+        if not prefix:
+            return self.users
+        positions = set(self._prefixed(self.by_email, prefix))
+        positions.update(self._prefixed(self.by_nickname, prefix))
+        return [self.users[position] for position in sorted(positions)]
+
+
+'''
+page_users(body, page)
+    the users of one /api/v2/users answer, a list or, with include_totals,
+    an object holding it. Anything else is a ManagementAPIError.
+'''
+def page_users(body, page):
+    users = body.get('users') if isinstance(body, dict) else body
+    if not isinstance(users, list) or not all(isinstance(user, dict) and 'user_id' in user for user in users):
+        # the API did answer (200), just not with users
+        raise ManagementAPIError(f'unexpected answer for page {page} of /api/v2/users', 200)
+    return users
+
+
+'''
+UserDirectory(client, ttl, per_page, workers)
+    a local copy of the tenant's users (email, nickname, user_id), read
+    from /api/v2/users through a ManagementClient. The first page asks for
+    the total, the remaining pages are fetched concurrently by at most
+    `workers` threads. The copy is kept for `ttl` seconds; after that the
+    old one is still served while a background thread reloads it, so only
+    the very first request waits for the API.
+
+    Page based listing stops at Auth0's limit of 1000 users per query,
+    so for bigger tenants the copy holds the first 1000 and is flagged
+    truncated; all of them would take the user export job.
+'''
+class UserDirectory:
+    def __init__(self, client, ttl=300, per_page=MAX_PER_PAGE, workers=4):
+        self.client = client
+        self.ttl = ttl
+        self.per_page = min(per_page, MAX_PER_PAGE)
+        self.workers = workers
+        self.snapshot = None
+        self.loaded_at = 0.0
+        self.load_attempted_at = 0.0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+
+    '''
+    from_env(client)
+        a UserDirectory configured from the environment:
+          AUTH0_USERS_TTL        seconds before the copy is reloaded (default 300)
+          AUTH0_USERS_WORKERS    pages fetched at the same time (default 4)
+    '''
+    @classmethod
+    def from_env(cls, client):
+        return cls(
+            client,
+            ttl=float(os.environ.get('AUTH0_USERS_TTL', 300)),
+            workers=int(os.environ.get('AUTH0_USERS_WORKERS', 4)),
+        )
+
+    def _page(self, page, include_totals=False):
+        query = urlencode({
+            'page': page,
+            'per_page': self.per_page,
+            'include_totals': 'true' if include_totals else 'false',
+            'fields': 'email,nickname,user_id',
+            'include_fields': 'true',
+        })
+        return self.client.get(f'/api/v2/users?{query}')
+
+    def _page_users(self, page, include_totals=False):
+        return page_users(self._page(page, include_totals), page)
+
+    '''
+    fetch()
+        (users, total): every user of the tenant that can be listed, one
+        request per page, and how many there are. Raises
+        ManagementAPIError when a page isn't a list of users.
+    '''
+    def fetch(self):
+        max_pages = LIST_LIMIT // self.per_page
+        first = self._page(0, include_totals=True)
+        if isinstance(first, list):
+            # the API ignored include_totals, page until a short page
+            batch = page_users(first, 0)
+            users, page = list(batch), 0
+            while len(batch) == self.per_page and page + 1 < max_pages:
+                page += 1
+                batch = self._page_users(page)
+                users.extend(batch)
+            total = None
+        else:
+            users = list(page_users(first, 0))
+            total = first.get('total')
+            if not isinstance(total, int) or isinstance(total, bool):
+                total = len(users)
+            pages = min(math.ceil(total / self.per_page), max_pages)
+            if pages > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    for batch in executor.map(self._page_users, range(1, pages)):
+                        users.extend(batch)
+
+        return [User(user.get('email'), user.get('nickname'), user['user_id']) for user in users], total
+
+    '''
+    load()
+        reloads the copy. Concurrent callers share one load; raises
+        ManagementAPIError if it fails.
+    '''
+    def load(self):
+        started = time.monotonic()
+        with self._load_lock:
+            # another thread loaded it while this one waited
+            if self.load_attempted_at >= started:
+                if self.snapshot is None:
+                    raise self.last_error
+                return self.snapshot
+
+            self.load_attempted_at = time.monotonic()
+            try:
+                snapshot = Snapshot(*self.fetch())
+            except Exception as error:
+                self.last_error = error
+                raise
+
+            with self._lock:
+                self.snapshot = snapshot
+                self.loaded_at = time.monotonic()
+                self.last_error = None
+            return snapshot
+
+    def _reload_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            # keep serving the old copy
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshing or now - self.loaded_at < self.ttl:
+                return
+            # the last reload failed, give the API a moment
+            if now - self.load_attempted_at < min(self.ttl, RETRY_INTERVAL):
+                return
+            self._refreshing = True
+        threading.Thread(target=self._reload_in_background, name='user-directory-refresh', daemon=True).start()
+
+    def current(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return self.load()
+        self._maybe_reload()
+        return snapshot
+
+    '''
+    search(prefix, page, per_page)
+        one page (from 1) of the users whose email or nickname starts with
+        `prefix`, by email, the number of matches and whether the copy
+        searched is truncated
+    '''
+    def search(self, prefix='', page=1, per_page=50):
+        snapshot = self.current()
+        matches = snapshot.search(prefix)
+        start = (page - 1) * per_page
+        return matches[start:start + per_page], len(matches), snapshot.truncated
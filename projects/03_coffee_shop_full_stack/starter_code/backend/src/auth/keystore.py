@@ -0,0 +1,188 @@
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+import jose
+from jose import jwk
+
+from env import AUTH0_DOMAIN, ALGORITHMS
+
+# python-jose 3 takes Key objects as they are; older releases (including
+# the pinned python-jose-cryptodome) construct a Key out of every key they
+# are given, but wrap an already parsed pycryptodome key without parsing
+# it again
+JOSE_TAKES_KEY_OBJECTS = int(jose.__version__.split('.')[0]) >= 3
+
+'''
+KeyStoreError
+    the signing keys could not be fetched and there is no earlier copy
+    to fall back on
+'''
+class KeyStoreError(Exception):
+    pass
+
+
+'''
+verification_key(key)
+    the public key of a JWK, parsed once into the object jwt.decode
+    verifies with. Raises jose's JWKError for keys it can't use.
+'''
+def verification_key(key):
+    parsed = jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+    if JOSE_TAKES_KEY_OBJECTS:
+        return parsed
+    return parsed.prepared_key
+
+'''
+decode_key(key)
+    what to pass jwt.decode for a verification key: a one entry mapping,
+    whose values jose uses as they are. A bare key or a tuple doesn't do
+    on python-jose-cryptodome, which checks `'keys' in key` first and so
+    would compare the pycryptodome key with a string.
+'''
+def decode_key(key):
+    return {'signing_key': key}
+
+
+'''
+KeyStore(url, ttl, min_refetch_interval)
+    the signing keys of a JWKS document, indexed by kid and parsed into
+    verification keys as they are loaded, so verifying a token doesn't
+    decode the key's modulus and exponent again.
+
+    The document is fetched on first use and then served from memory.
+    Once it is older than `ttl` seconds the stale keys are still served
+    while a background thread fetches a fresh copy (stale while
+    revalidate), so no request waits on the network. A kid that is not
+    in the document (Auth0 rotated its key) triggers a refetch in the
+    request, at most once every `min_refetch_interval` seconds so tokens
+    with made up kids can't hammer the endpoint.
+
+    `url` may also be a file:// URL or a plain path to a local JWKS file.
+'''
+class KeyStore:
+    def __init__(self, url, ttl=600, min_refetch_interval=30, timeout=10):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.keys = None
+        self.fetched_at = 0.0
+        self.fetch_attempted_at = None
+        self.fetches = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+
+    '''
+    from_env()
+        a KeyStore configured from the environment:
+          AUTH0_JWKS_URL              where to read the keys (default the
+                                      tenant's /.well-known/jwks.json),
+                                      a path or file:// URL for offline use
+          AUTH0_JWKS_TTL              seconds before a background refresh (default 600)
+          AUTH0_JWKS_MIN_REFETCH      seconds between refetches for unknown kids (default 30)
+    '''
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.environ.get('AUTH0_JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'),
+            ttl=float(os.environ.get('AUTH0_JWKS_TTL', 600)),
+            min_refetch_interval=float(os.environ.get('AUTH0_JWKS_MIN_REFETCH', 30)),
+        )
+
+    def read_document(self):
+        if not urlsplit(self.url).scheme:
+            with open(self.url, 'rb') as f:
+                return json.loads(f.read())
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    '''
+    fetch()
+        reads the document and swaps in its keys. Concurrent callers share
+        one fetch: whoever waited on the lock finds the keys it just loaded.
+        Raises KeyStoreError if the document can't be read.
+    '''
+    def fetch(self):
+        started = time.monotonic()
+        with self._fetch_lock:
+            if self.fetch_attempted_at is not None and self.fetch_attempted_at >= started:
+                if self.keys is None:
+                    raise KeyStoreError(f'could not load the signing keys from {self.url}: {self.last_error}')
+                return self.keys
+
+            self.fetch_attempted_at = time.monotonic()
+            self.fetches += 1
+            try:
+                document = self.read_document()
+                keys = {}
+                for key in document['keys']:
+                    if 'kid' not in key or key.get('use', 'sig') != 'sig':
+                        continue
+                    try:
+                        keys[key['kid']] = verification_key(key)
+                    except jose.JOSEError:
+                        # not a key we could verify with (e.g. another algorithm)
+                        continue
+            except Exception as error:
+                self.last_error = error
+                raise KeyStoreError(f'could not load the signing keys from {self.url}: {error}') from error
+
+            with self._lock:
+                self.keys = keys
+                self.fetched_at = time.monotonic()
+                self.last_error = None
+            return keys
+
+    def _refresh_in_background(self):
+        try:
+            self.fetch()
+        except KeyStoreError:
+            # keep serving the keys we have, the next request tries again
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshing or now - self.fetched_at < self.ttl:
+                return
+            # the last refresh failed, don't retry on every request
+            if now - self.fetch_attempted_at < self.min_refetch_interval:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name='jwks-refresh', daemon=True).start()
+
+    '''
+    get(kid)
+        the verification key with this kid, or None if the issuer doesn't
+        have it
+    '''
+    def get(self, kid):
+        keys = self.keys
+        if keys is None:
+            keys = self.fetch()
+        else:
+            self._maybe_refresh()
+
+        key = keys.get(kid)
+        if key is not None:
+            return key
+
+        with self._lock:
+            recently = self.fetch_attempted_at is not None and \
+                time.monotonic() - self.fetch_attempted_at < self.min_refetch_interval
+        if recently:
+            return None
+        try:
+            keys = self.fetch()
+        except KeyStoreError:
+            return None
+        return keys.get(kid)
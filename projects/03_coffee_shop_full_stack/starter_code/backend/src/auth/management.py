@@ -0,0 +1,190 @@
+import http.client
+import json
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from env import AUTH0_DOMAIN, M_TO_M_CLIENT_ID, M_TO_M_CLIENT_SECRET
+
+'''
+ManagementAPIError
+    the management API could not be reached, refused the client's
+    credentials or answered with an error
+'''
+class ManagementAPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+'''
+ConnectionPool(base_url, size, timeout)
+    keep-alive connections to one host. http.client connections can't be
+    shared between threads, so each request checks one out and puts it
+    back afterwards; at most `size` idle ones are kept.
+'''
+class ConnectionPool:
+    def __init__(self, base_url, size=4, timeout=10):
+        parts = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.opened = 0
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            self.opened += 1
+            return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def _checkin(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    '''
+    request(method, path, body, headers)
+        (status, body bytes). A kept-alive connection the server closed in
+        the meantime is replaced and the request sent again.
+    '''
+    def request(self, method, path, body=None, headers=None):
+        while True:
+            connection, reused = self._checkout()
+            try:
+                connection.request(method, self.prefix + path, body, headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+'''
+ManagementClient(base_url, client_id, client_secret, audience)
+    calls the Auth0 management API with a client credentials token. The
+    token is requested once and reused until `refresh_margin` seconds
+    before it expires; when it has to be renewed only one thread asks for
+    it while the others wait for its answer. Every call goes through the
+    same pool of keep-alive connections.
+'''
+class ManagementClient:
+    def __init__(self, base_url, client_id, client_secret, audience,
+                 refresh_margin=60, connections=4, timeout=10):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.audience = audience
+        self.refresh_margin = refresh_margin
+        self.pool = ConnectionPool(base_url, connections, timeout)
+        self.token_requests = 0
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+    '''
+    from_env()
+        a ManagementClient for the tenant in env.py. The environment can
+        override:
+          AUTH0_MANAGEMENT_URL            where to send the calls (default
+                                          https://AUTH0_DOMAIN), e.g. a local
+                                          stand-in server
+          AUTH0_MANAGEMENT_TOKEN_MARGIN   seconds before expiry to renew the token (default 60)
+          AUTH0_MANAGEMENT_CONNECTIONS    idle keep-alive connections kept (default 4)
+    '''
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.environ.get('AUTH0_MANAGEMENT_URL', f'https://{AUTH0_DOMAIN}'),
+            M_TO_M_CLIENT_ID,
+            M_TO_M_CLIENT_SECRET,
+            f'https://{AUTH0_DOMAIN}/api/v2/',
+            refresh_margin=float(os.environ.get('AUTH0_MANAGEMENT_TOKEN_MARGIN', 60)),
+            connections=int(os.environ.get('AUTH0_MANAGEMENT_CONNECTIONS', 4)),
+        )
+
+    def _request_json(self, method, path, body=None, headers=None):
+        try:
+            status, data = self.pool.request(method, path, body, headers)
+        except (OSError, http.client.HTTPException) as error:
+            raise ManagementAPIError(f'{method} {path} failed: {error}') from error
+        try:
+            document = json.loads(data.decode('utf-8')) if data else None
+        except ValueError:
+            document = None
+        return status, document
+
+    def _fetch_token(self):
+        self.token_requests += 1
+        payload = urlencode({
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'audience': self.audience,
+        })
+        status, document = self._request_json('POST', '/oauth/token', payload,
+                                              {'content-type': 'application/x-www-form-urlencoded'})
+        if status != 200 or not isinstance(document, dict) or not document.get('access_token'):
+            raise ManagementAPIError('could not get a management API token', status)
+
+        self._token = document['access_token']
+        self._token_expires_at = time.monotonic() + float(document.get('expires_in', 0))
+
+    '''
+    access_token()
+        the current management API token, renewed first if it is about
+        to expire
+    '''
+    def access_token(self):
+        if self._token is not None and time.monotonic() < self._token_expires_at - self.refresh_margin:
+            return self._token
+
+        with self._token_lock:
+            # another thread may have renewed it while this one waited
+            if self._token is None or time.monotonic() >= self._token_expires_at - self.refresh_margin:
+                self._fetch_token()
+            return self._token
+
+    def invalidate_token(self, token):
+        with self._token_lock:
+            if self._token == token:
+                self._token = None
+
+    '''
+    get(path)
+        the JSON document at `path`. A 401 drops the token (it was revoked
+        or the tenant's signing key changed) and the call is tried once
+        more with a new one.
+    '''
+    def get(self, path):
+        for attempt in range(2):
+            token = self.access_token()
+            status, document = self._request_json('GET', path, headers={'Authorization': f'Bearer {token}'})
+            if status == 401 and attempt == 0:
+                self.invalidate_token(token)
+                continue
+            if status != 200:
+                raise ManagementAPIError(f'GET {path} answered {status}', status)
+            return document
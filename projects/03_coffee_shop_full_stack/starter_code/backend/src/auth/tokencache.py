@@ -0,0 +1,81 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+'''
+TokenCache(max_size)
+    the payloads of tokens that passed verification, so a client sending
+    the same bearer token again skips the signature check and the claims
+    validation. Entries are keyed by the SHA-256 of the token (the tokens
+    themselves are not kept), expire at the token's `exp` and the least
+    recently used one is dropped once there are `max_size` of them.
+    A max_size of 0 turns the cache off.
+'''
+class TokenCache:
+    def __init__(self, max_size=1024, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    from_env()
+        a TokenCache of AUTH0_TOKEN_CACHE_SIZE entries (default 1024)
+    '''
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.environ.get('AUTH0_TOKEN_CACHE_SIZE', 1024)))
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    '''
+    get(token)
+        the cached payload of this token, None if it was not verified
+        before or has expired since
+    '''
+    def get(self, token):
+        if not self.max_size:
+            return None
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    '''
+    put(token, payload)
+        remembers a verified payload until its `exp`; tokens without one
+        are not cached
+    '''
+    def put(self, token, payload):
+        expires_at = payload.get('exp')
+        if not self.max_size or not isinstance(expires_at, (int, float)):
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,23 +1,38 @@
 import os
 from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
 import json
 
+from .pool import engine_options, pool_status
+from .routing import RoutingSQLAlchemy, init_replicas
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
+database_path = os.environ.get('DATABASE_URL', "sqlite:///{}".format(os.path.join(project_dir, database_filename)))
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    DATABASE_URL overrides the sqlite file, the connection pool is
+    configured from the environment (see pool.engine_options)
+    GET requests read from the replicas in DATABASE_REPLICA_URLS, if any
+    (see routing.init_replicas)
 '''
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    init_replicas(app)
+
+'''
+db_pool_status()
+    live statistics of the connection pool
+'''
+def db_pool_status():
+    return pool_status(db.engine)
 
 '''
 db_drop_and_create_all()
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# vendored into the other apps: edit the trivia backend's copy and run
+# projects/shared_modules.py --write to regenerate the others
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+'''
+engine_options(database_path)
+    SQLAlchemy engine options read from the environment:
+      DB_POOL_SIZE       connections kept open (default 5)
+      DB_MAX_OVERFLOW    extra connections allowed under load (default 10)
+      DB_POOL_TIMEOUT    seconds to wait for a connection (default 30)
+      DB_POOL_RECYCLE    reconnect connections older than this, -1 never (default 1800)
+      DB_POOL_PRE_PING   test connections on checkout (default true)
+    SQLite keeps the pool SQLAlchemy picks for it, only recycle and
+    pre-ping apply there.
+'''
+def engine_options(database_path):
+    options = {
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() in TRUE_VALUES,
+    }
+    if not database_path.startswith('sqlite'):
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        })
+    return options
+
+
+'''
+TimedQueuePool
+    a QueuePool that also records how long checkouts wait for a
+    connection and how many of them time out
+'''
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+    def wait_stats(self):
+        with self._stats_lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total_seconds': round(self.wait_total, 6),
+                'wait_avg_seconds': round(self.wait_total / self.checkouts, 6) if self.checkouts else 0.0,
+                'wait_max_seconds': round(self.wait_max, 6),
+            }
+
+
+'''
+pool_status(engine)
+    live numbers of an engine's pool, for the introspection endpoint
+'''
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow(),
+            'max_overflow': pool._max_overflow,
+            'timeout': pool.timeout(),
+        })
+    else:
+        status['status'] = pool.status()
+    if isinstance(pool, TimedQueuePool):
+        status.update(pool.wait_stats())
+    return status
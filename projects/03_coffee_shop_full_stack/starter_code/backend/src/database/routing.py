@@ -0,0 +1,157 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+from sqlalchemy.sql.expression import UpdateBase
+
+from .pool import engine_options
+
+# vendored into the other apps: edit the trivia backend's copy and run
+# projects/shared_modules.py --write to regenerate the others
+
+READ_METHODS = ('GET', 'HEAD')
+PRIMARY_COOKIE = 'db_primary_until'
+PRIMARY_HEADER = 'X-DB-Primary-Until'
+
+'''
+ReplicaRouter
+    the read replicas of an app. GET and HEAD requests read from one of
+    them, picked round robin once per request so a request sees a single
+    replica. Everything else goes to the primary, and so do reads for
+    `sticky_seconds` after a write, which covers the replicas' lag:
+    - every read of this process after any write it made, so a client
+      that sends nothing back still reads its own writes from the same
+      worker
+    - the reads of a client that echoes the X-DB-Primary-Until header
+      (or, same origin, the db_primary_until cookie) of the response to
+      its write, whichever worker serves them
+'''
+class ReplicaRouter:
+    def __init__(self, urls, sticky_seconds=5):
+        self.engines = [create_engine(url, **engine_options(url)) for url in urls]
+        self.sticky_seconds = sticky_seconds
+        self.primary_until = 0
+        self._cycle = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+
+    def next_engine(self):
+        with self._lock:
+            return next(self._cycle)
+
+    def wrote(self):
+        self.primary_until = time.time() + self.sticky_seconds
+
+    def engine_for_request(self):
+        if not self.engines or not has_request_context():
+            return None
+        if request.method not in READ_METHODS or g.get('db_wrote') or g.get('db_primary'):
+            return None
+        now = time.time()
+        if self.primary_until > now or client_primary_until() > now:
+            return None
+
+        if 'db_replica' not in g:
+            g.db_replica = self.next_engine()
+        return g.db_replica
+
+
+'''
+client_primary_until()
+    the time until which the client asked to stay on the primary, from
+    the X-DB-Primary-Until header or the db_primary_until cookie
+'''
+def client_primary_until():
+    until = 0
+    for value in (request.headers.get(PRIMARY_HEADER), request.cookies.get(PRIMARY_COOKIE)):
+        try:
+            until = max(until, float(value or 0))
+        except ValueError:
+            pass
+    return until
+
+
+'''
+on_primary()
+    context manager, the reads inside it go to the primary even in a GET
+    request. For loaders that fill caches shared by every request, which
+    must not keep a lagging replica's rows.
+'''
+@contextmanager
+def on_primary():
+    if not has_request_context():
+        yield
+        return
+
+    previous = g.get('db_primary', False)
+    g.db_primary = True
+    try:
+        yield
+    finally:
+        g.db_primary = previous
+
+
+'''
+RoutingSession
+    sends the reads of a GET or HEAD request to the app's replica, and
+    flushes and INSERT/UPDATE/DELETE statements to the primary (marking
+    the request and the router as writers). Without replicas it is a plain
+    SignallingSession.
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replica_router')
+        if router is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                router.wrote()
+                if has_request_context():
+                    g.db_wrote = True
+            else:
+                engine = router.engine_for_request()
+                if engine is not None:
+                    return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+'''
+stick_to_primary(response)
+    after_request hook, the response to a request that wrote tells its
+    client until when to stay on the primary, in the X-DB-Primary-Until
+    header (exposed to cross-origin scripts) and the db_primary_until cookie
+'''
+def stick_to_primary(response):
+    router = current_app.extensions.get('replica_router')
+    if router is not None and g.get('db_wrote') and router.sticky_seconds > 0:
+        until = '{:.3f}'.format(time.time() + router.sticky_seconds)
+        response.headers[PRIMARY_HEADER] = until
+        response.headers.add('Access-Control-Expose-Headers', PRIMARY_HEADER)
+        response.set_cookie(PRIMARY_COOKIE, until,
+            max_age=max(1, int(router.sticky_seconds)), httponly=True)
+    return response
+
+
+'''
+init_replicas(app)
+    reads the replica URIs from the DATABASE_REPLICA_URLS config key or
+    environment variable (comma separated) and DB_REPLICA_STICKY_SECONDS
+    (default 5). Returns the router, None when there are no replicas.
+'''
+def init_replicas(app):
+    app.after_request(stick_to_primary)
+    urls = app.config.get('DATABASE_REPLICA_URLS', os.environ.get('DATABASE_REPLICA_URLS', ''))
+    urls = [url.strip() for url in urls.split(',') if url.strip()]
+    if not urls:
+        return None
+
+    router = ReplicaRouter(urls, float(os.environ.get('DB_REPLICA_STICKY_SECONDS', 5)))
+    app.extensions['replica_router'] = router
+    return router
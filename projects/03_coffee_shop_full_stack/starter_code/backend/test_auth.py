@@ -0,0 +1,312 @@
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from jose import jwt
+
+from env import API_AUDIENCE, AUTH0_DOMAIN
+from auth import auth
+from auth.auth import AuthError, verify_decode_jwt
+from auth.keystore import KeyStore
+from auth.tokencache import TokenCache
+from auth.directory import UserDirectory
+from auth.management import ManagementAPIError, ManagementClient
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def generate_key(kid):
+    """A 2048 bit private key in PEM and its public JWK, with pycryptodome
+    (which the pinned python-jose-cryptodome uses) or python-rsa."""
+    try:
+        from Crypto.PublicKey import RSA
+        private = RSA.generate(2048)
+        pem = private.exportKey('PEM').decode()
+        n, e = private.n, private.e
+    except ImportError:
+        import rsa
+        public, private = rsa.newkeys(2048)
+        pem = private.save_pkcs1().decode()
+        n, e = public.n, public.e
+    return pem, {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256', 'n': b64_int(n), 'e': b64_int(e)}
+
+
+class VerifyDecodeJWTTestCase(unittest.TestCase):
+    """verify_decode_jwt against a local JWKS file"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, jwk = generate_key('test-key')
+        handle, cls.jwks_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'keys': [jwk]}, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.jwks_path)
+
+    def setUp(self):
+        self.jwks, self.verified_tokens = auth.jwks, auth.verified_tokens
+        auth.jwks = KeyStore(self.jwks_path)
+        auth.verified_tokens = TokenCache()
+
+    def tearDown(self):
+        auth.jwks, auth.verified_tokens = self.jwks, self.verified_tokens
+
+    def token(self, kid='test-key', expires_in=3600, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'aud': API_AUDIENCE,
+            'sub': 'auth0|test',
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': ['get:drinks-detail'],
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.pem, algorithm='RS256', headers={'kid': kid})
+
+    def test_verifies_signed_token(self):
+        payload = verify_decode_jwt(self.token())
+
+        self.assertEqual(payload['sub'], 'auth0|test')
+        self.assertEqual(payload['permissions'], ['get:drinks-detail'])
+        self.assertEqual(auth.jwks.fetches, 1)
+
+    def test_verified_token_is_cached(self):
+        token = self.token()
+        verify_decode_jwt(token)
+        verify_decode_jwt(token)
+
+        self.assertEqual(auth.verified_tokens.hits, 1)
+
+    def test_rejects_tampered_token(self):
+        header, payload, signature = self.token().split('.')
+        forged = base64.urlsafe_b64encode(json.dumps({'sub': 'auth0|admin'}).encode()).rstrip(b'=').decode()
+
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt('.'.join([header, forged, signature]))
+        self.assertEqual(raised.exception.status_code, 400)
+
+    def test_rejects_expired_token(self):
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(self.token(expires_in=-60))
+        self.assertEqual(raised.exception.error['code'], 'token_expired')
+
+    def test_rejects_wrong_audience(self):
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(self.token(aud='another_api'))
+        self.assertEqual(raised.exception.error['code'], 'invalid_claims')
+
+    def test_unknown_kid(self):
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(self.token(kid='rotated-key'))
+        self.assertEqual(raised.exception.error['description'], 'Unable to find the appropriate key.')
+
+    def test_jwks_unavailable(self):
+        auth.jwks = KeyStore(os.path.join(tempfile.gettempdir(), 'no-such-jwks.json'))
+
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(self.token())
+        self.assertEqual(raised.exception.status_code, 503)
+
+
+class StubManagementClient:
+    """Answers /api/v2/users like Auth0 does: pages of at most 100 users,
+    and an error for pages past the first 1000 users."""
+
+    def __init__(self, users):
+        self.users = [{'email': f'user{i:05d}@example.com', 'nickname': f'nick{i:05d}', 'user_id': f'auth0|{i}'}
+                      for i in range(users)]
+        self.pages = []
+
+    def get(self, path):
+        query = {key: values[0] for key, values in parse_qs(urlsplit(path).query).items()}
+        page, per_page = int(query['page']), int(query['per_page'])
+        self.pages.append(page)
+        if per_page > 100 or (page + 1) * per_page > 1000:
+            raise ManagementAPIError(f'GET {path} answered 400', 400)
+
+        users = self.users[page * per_page:(page + 1) * per_page]
+        if query['include_totals'] == 'true':
+            return {'start': page * per_page, 'limit': per_page, 'length': len(users),
+                    'total': len(self.users), 'users': users}
+        return users
+
+
+class UserDirectoryTestCase(unittest.TestCase):
+    """UserDirectory against a stubbed management API"""
+
+    def test_loads_every_page(self):
+        client = StubManagementClient(250)
+        directory = UserDirectory(client, workers=2)
+
+        users, total, truncated = directory.search(page=3, per_page=100)
+
+        self.assertEqual(total, 250)
+        self.assertFalse(truncated)
+        self.assertEqual(len(users), 50)
+        self.assertEqual(users[-1].email, 'user00249@example.com')
+        self.assertEqual(sorted(client.pages), [0, 1, 2])
+
+    def test_stops_at_the_listing_limit(self):
+        client = StubManagementClient(2500)
+        directory = UserDirectory(client)
+
+        users, total, truncated = directory.search(per_page=100)
+
+        self.assertTrue(truncated)
+        self.assertEqual(total, 1000)
+        self.assertEqual(directory.snapshot.total, 2500)
+        self.assertEqual(max(client.pages), 9)
+
+    def test_unexpected_answer(self):
+        client = StubManagementClient(10)
+        client.get = lambda path: {'total': 10}
+        directory = UserDirectory(client)
+
+        with self.assertRaises(ManagementAPIError):
+            directory.search()
+
+    def test_prefix_search(self):
+        directory = UserDirectory(StubManagementClient(300))
+
+        users, total, truncated = directory.search('NICK0012', per_page=5)
+
+        self.assertEqual(total, 10)
+        self.assertEqual([user.nickname for user in users], ['nick00120', 'nick00121', 'nick00122', 'nick00123', 'nick00124'])
+
+
+class ManagementStandIn(ThreadingHTTPServer):
+    """A local Auth0 stand-in: /oauth/token hands out token-1, token-2, ...
+    after `token_delay` seconds and GET answers 401 to the tokens in
+    `revoked`. It counts the token requests and the TCP connections."""
+    daemon_threads = True
+
+    def __init__(self, token_delay=0.0):
+        super().__init__(('127.0.0.1', 0), ManagementStandInHandler)
+        self.token_delay = token_delay
+        self.revoked = set()
+        self.tokens_issued = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class ManagementStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        with self.server.lock:
+            self.server.connections += 1
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, document):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.token_delay)
+        with self.server.lock:
+            self.server.tokens_issued += 1
+            token = f'token-{self.server.tokens_issued}'
+        self.send_json(200, {'access_token': token, 'expires_in': 86400, 'token_type': 'Bearer'})
+
+    def do_GET(self):
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        if not token or token in self.server.revoked:
+            return self.send_json(401, {'error': 'unauthorized'})
+        self.send_json(200, {'path': self.path, 'token': token})
+
+
+class ManagementClientTestCase(unittest.TestCase):
+    """ManagementClient against a local stand-in of the management API"""
+
+    def start(self, **options):
+        server = ManagementStandIn(**options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client = ManagementClient(f'http://127.0.0.1:{server.server_port}', 'id', 'secret', 'audience')
+        self.addCleanup(client.pool.close)
+        return server, client
+
+    def test_reuses_token_and_connection(self):
+        server, client = self.start()
+
+        for page in range(5):
+            self.assertEqual(client.get(f'/api/v2/users?page={page}')['token'], 'token-1')
+
+        self.assertEqual(client.token_requests, 1)
+        self.assertEqual(server.tokens_issued, 1)
+        self.assertEqual(client.pool.opened, 1)
+        self.assertEqual(server.connections, 1)
+
+    def test_concurrent_calls_share_one_token_request(self):
+        server, client = self.start(token_delay=0.2)
+        barrier = threading.Barrier(8)
+        tokens = []
+
+        def call():
+            barrier.wait()
+            tokens.append(client.get('/api/v2/users')['token'])
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['token-1'] * 8)
+        self.assertEqual(client.token_requests, 1)
+        self.assertEqual(server.tokens_issued, 1)
+        # every connection the client opened is one TCP connection, and
+        # the calls that follow reuse the idle ones
+        self.assertEqual(server.connections, client.pool.opened)
+        opened = client.pool.opened
+        for _ in range(5):
+            client.get('/api/v2/users')
+        self.assertEqual(client.pool.opened, opened)
+        self.assertEqual(server.connections, opened)
+
+    def test_renews_token_after_401(self):
+        server, client = self.start()
+        client.get('/api/v2/users')
+        server.revoked.add('token-1')
+
+        self.assertEqual(client.get('/api/v2/users')['token'], 'token-2')
+        self.assertEqual(client.token_requests, 2)
+        self.assertEqual(server.connections, 1)
+
+    def test_gives_up_after_second_401(self):
+        server, client = self.start()
+        server.revoked.update({'token-1', 'token-2'})
+
+        with self.assertRaises(ManagementAPIError) as raised:
+            client.get('/api/v2/users')
+        self.assertEqual(raised.exception.status, 401)
+        self.assertEqual(client.token_requests, 2)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Modules shared by the trivia backend, the coffee shop backend and fyyur.
+
+Every project is a standalone app, deployed from its own directory with
+its own requirements, so a module they all use is vendored into each of
+them rather than installed as a package. The trivia backend holds the
+original (2 space indents); the other copies are generated from it with
+4 space indents and package relative imports where the app needs them.
+
+    python projects/shared_modules.py          # lists the copies that drifted, exit status 1 if any
+    python projects/shared_modules.py --write  # regenerates the copies
+
+Edit the trivia module, then run --write.
+'''
+import argparse
+import os
+import re
+import sys
+
+PROJECTS = os.path.dirname(os.path.abspath(__file__))
+TRIVIA = os.path.join('02_trivia_api', 'starter', 'backend')
+COFFEE = os.path.join('03_coffee_shop_full_stack', 'starter_code', 'backend')
+FYYUR = os.path.join('01_fyyur', 'starter_code')
+
+# (original, copy, [(text, replacement), ...])
+COPIES = [
+    (os.path.join(TRIVIA, 'instrumentation.py'), os.path.join(COFFEE, 'src', 'instrumentation.py'), []),
+    (os.path.join(TRIVIA, 'instrumentation.py'), os.path.join(FYYUR, 'instrumentation.py'), []),
+    (os.path.join(TRIVIA, 'pool.py'), os.path.join(COFFEE, 'src', 'database', 'pool.py'), []),
+    (os.path.join(TRIVIA, 'routing.py'), os.path.join(COFFEE, 'src', 'database', 'routing.py'),
+     [('from pool import', 'from .pool import')]),
+]
+
+
+def reindent(source):
+    """Doubles the indentation of the code. The text of a ''' comment
+    block keeps its own layout, only shifted along with the block."""
+    lines = []
+    block_shift = None
+    for line in source.split('\n'):
+        if line.strip() == "'''":
+            lead = len(line) - len(line.lstrip())
+            lines.append(' ' * lead + line)
+            block_shift = lead if block_shift is None else None
+        elif block_shift is not None:
+            lines.append(' ' * block_shift + line if line else line)
+        else:
+            lines.append(re.sub(r'^( +)', lambda match: match.group(1) * 2, line))
+    return '\n'.join(lines)
+
+
+def expected_copy(original, replacements):
+    with open(os.path.join(PROJECTS, original)) as f:
+        text = reindent(f.read())
+    for old, new in replacements:
+        text = text.replace(old, new)
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check or regenerate the vendored copies of shared modules.')
+    parser.add_argument('--write', action='store_true', help='regenerate the copies from the trivia originals')
+    args = parser.parse_args(argv)
+
+    drifted = []
+    for original, copy, replacements in COPIES:
+        expected = expected_copy(original, replacements)
+        path = os.path.join(PROJECTS, copy)
+        with open(path) as f:
+            current = f.read()
+        if current == expected:
+            continue
+        if args.write:
+            with open(path, 'w') as f:
+                f.write(expected)
+            print(f'wrote {copy}')
+        else:
+            drifted.append(copy)
+            print(f'{copy} differs from {original}')
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())